@@ -0,0 +1,2 @@
+-- migrate: no-transaction
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS flight_number_key ON flight (number);
@@ -0,0 +1,9 @@
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint WHERE conrelid = 'flight'::regclass AND conname = 'flight_number_key'
+    ) THEN
+        ALTER TABLE flight ADD CONSTRAINT flight_number_key UNIQUE USING INDEX flight_number_key;
+    END IF;
+END
+$$;
@@ -0,0 +1,38 @@
+CREATE OR REPLACE FUNCTION notify_flight_catalog() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':*');
+    ELSIF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':' || NEW.id);
+    ELSE
+        PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':' || OLD.id);
+
+        IF TG_OP = 'UPDATE' AND NEW.id <> OLD.id THEN
+            PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':' || NEW.id);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS flight_catalog_notify ON flight;
+CREATE TRIGGER flight_catalog_notify
+    AFTER INSERT OR UPDATE OR DELETE ON flight
+    FOR EACH ROW EXECUTE FUNCTION notify_flight_catalog();
+
+DROP TRIGGER IF EXISTS flight_catalog_notify_truncate ON flight;
+CREATE TRIGGER flight_catalog_notify_truncate
+    AFTER TRUNCATE ON flight
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_flight_catalog();
+
+DROP TRIGGER IF EXISTS airport_catalog_notify ON airport;
+CREATE TRIGGER airport_catalog_notify
+    AFTER INSERT OR UPDATE OR DELETE ON airport
+    FOR EACH ROW EXECUTE FUNCTION notify_flight_catalog();
+
+DROP TRIGGER IF EXISTS airport_catalog_notify_truncate ON airport;
+CREATE TRIGGER airport_catalog_notify_truncate
+    AFTER TRUNCATE ON airport
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_flight_catalog();
@@ -0,0 +1,3 @@
+ALTER TABLE ticket ADD COLUMN IF NOT EXISTS from_airport VARCHAR(511);
+ALTER TABLE ticket ADD COLUMN IF NOT EXISTS to_airport   VARCHAR(511);
+ALTER TABLE ticket ADD COLUMN IF NOT EXISTS flight_date  TIMESTAMP WITH TIME ZONE;
@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS idempotency_key
+(
+    username      VARCHAR(80)              NOT NULL,
+    key           VARCHAR(255)             NOT NULL,
+    request_hash  CHAR(64)                 NOT NULL,
+    response_code INT,
+    response_body TEXT,
+    created_at    TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (username, key)
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_key_created_at_idx ON idempotency_key (created_at);
@@ -0,0 +1,2 @@
+-- migrate: no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_username_id_idx ON ticket (username, id);
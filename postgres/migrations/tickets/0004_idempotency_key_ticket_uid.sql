@@ -0,0 +1 @@
+ALTER TABLE idempotency_key ADD COLUMN IF NOT EXISTS ticket_uid uuid;
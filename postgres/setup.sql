@@ -12,7 +12,7 @@ CREATE TABLE airport
 CREATE TABLE flight
 (
     id              SERIAL PRIMARY KEY,
-    number          VARCHAR(20)              NOT NULL,
+    number          VARCHAR(20)              NOT NULL UNIQUE,
     datetime        TIMESTAMP WITH TIME ZONE NOT NULL,
     from_airport_id INT REFERENCES airport (id),
     to_airport_id   INT REFERENCES airport (id),
@@ -24,6 +24,41 @@ INSERT INTO airport(name, city, country) VALUES ('Пулково', 'Санкт-
 INSERT INTO flight(number, datetime, from_airport_id, to_airport_id, price)
 VALUES ('AFL031', '2021-10-08 20:00', 2, 1, 1500);
 
+CREATE OR REPLACE FUNCTION notify_flight_catalog() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':*');
+    ELSIF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':' || NEW.id);
+    ELSE
+        PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':' || OLD.id);
+
+        IF TG_OP = 'UPDATE' AND NEW.id <> OLD.id THEN
+            PERFORM pg_notify('flight_catalog', TG_TABLE_NAME || ':' || NEW.id);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER flight_catalog_notify
+    AFTER INSERT OR UPDATE OR DELETE ON flight
+    FOR EACH ROW EXECUTE FUNCTION notify_flight_catalog();
+
+CREATE TRIGGER flight_catalog_notify_truncate
+    AFTER TRUNCATE ON flight
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_flight_catalog();
+
+CREATE TRIGGER airport_catalog_notify
+    AFTER INSERT OR UPDATE OR DELETE ON airport
+    FOR EACH ROW EXECUTE FUNCTION notify_flight_catalog();
+
+CREATE TRIGGER airport_catalog_notify_truncate
+    AFTER TRUNCATE ON airport
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_flight_catalog();
+
 CREATE DATABASE tickets;
 \c tickets;
 
@@ -34,9 +69,28 @@ CREATE TABLE ticket
     username      VARCHAR(80) NOT NULL,
     flight_number VARCHAR(20) NOT NULL,
     price         INT         NOT NULL,
-    status        VARCHAR(20) NOT NULL CHECK (status IN ('PAID', 'CANCELED'))
+    status        VARCHAR(20) NOT NULL CHECK (status IN ('PAID', 'CANCELED')),
+    from_airport  VARCHAR(511),
+    to_airport    VARCHAR(511),
+    flight_date   TIMESTAMP WITH TIME ZONE
 );
 
+CREATE INDEX ticket_username_id_idx ON ticket (username, id);
+
+CREATE TABLE idempotency_key
+(
+    username      VARCHAR(80)              NOT NULL,
+    key           VARCHAR(255)             NOT NULL,
+    request_hash  CHAR(64)                 NOT NULL,
+    response_code INT,
+    response_body TEXT,
+    ticket_uid    uuid,
+    created_at    TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (username, key)
+);
+
+CREATE INDEX idempotency_key_created_at_idx ON idempotency_key (created_at);
+
 
 CREATE DATABASE privileges;
 \c privileges;
@@ -57,4 +111,7 @@ CREATE TABLE privilege_history
     datetime       TIMESTAMP   NOT NULL,
     balance_diff   INT         NOT NULL,
     operation_type VARCHAR(20) NOT NULL CHECK (operation_type IN ('FILL_IN_BALANCE', 'DEBIT_THE_ACCOUNT'))
-);
\ No newline at end of file
+);
+
+CREATE INDEX privilege_history_privilege_id_idx ON privilege_history (privilege_id);
+CREATE INDEX privilege_history_ticket_uid_idx ON privilege_history (ticket_uid);
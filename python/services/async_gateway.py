@@ -0,0 +1,385 @@
+import asyncio
+import contextvars
+import time
+
+import aiohttp
+from aiohttp import web
+
+from gateway import Gateway
+from gateway import RequestBackup
+from gateway import ALL_METHODS
+from gateway import UNAVAILABLE_CODES
+from gateway import STREAM_CHUNK_SIZE
+
+from cache import AsyncSingleFlight
+
+from errors import UserError
+from errors import ServerError
+from getters import UserValue
+import rules
+import tools
+
+
+_request_identity = contextvars.ContextVar('request_identity', default=None)
+
+
+class AsyncGateway(Gateway):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._client_session = None
+        self._in_flight = {}
+        self._async_single_flight = AsyncSingleFlight()
+        self._revalidation_tasks = set()
+
+        self._web_app = web.Application(middlewares=[self._handle_errors])
+        self._web_app.on_startup.append(self._create_client_session)
+        self._web_app.on_cleanup.append(self._close_client_session)
+
+        self._register_async_routes()
+
+    def run(self, debug=False):
+        self._start_health_prober()
+        self._start_endpoints_refresher()
+        self._replay_queue.start()
+
+        self._logger.info(f'Run async service on http://{self._host}:{self._port}')
+
+        try:
+            web.run_app(self._web_app, host=self._host, port=self._port, print=None)
+
+        except Exception as exception:
+            self._logger.error(f'Failed while run async app, error: {exception}')
+
+            raise
+
+        self._logger.info(f'End service run')
+
+    ################################################################################################
+
+    async def _flight_async(self, request):
+        return await self._resend_async(self._flight_service_info, request, cacheable=True)
+
+    async def _privilege_async(self, request):
+        return await self._resend_async(self._bonus_service_info, request)
+
+    async def _tickets_async(self, request):
+        return await self._resend_async(self._ticket_service_info, request)
+
+    async def _authorize_async(self, request):
+        UserValue.get_from(request.headers, 'Content-Type').rule(rules.json_content)
+
+        body = await request.json()
+        username = UserValue.get_from(body, 'username').expected(str).value
+        password = UserValue.get_from(body, 'password').expected(str).value
+
+        async with self._client_session.request(
+            'POST',
+            f'{self._authorize_service_info.url}/oauth/token',
+            data={
+                'client_id': self._authorize_service_info.api_key,
+                'client_secret': self._authorize_service_info.secret_key,
+                'grant_type': 'password',
+                'username': username,
+                'password': password,
+                'audience': f'{self._authorize_service_info.url}/api/v2/',
+                'scope': 'openid'
+            }
+        ) as response:
+            if response.content_type == 'application/json':
+                token = await response.json()
+
+                await self._run_in_executor(self._validate_token, token['access_token'])
+
+                return web.json_response(token, status=response.status)
+
+            return web.Response(text=await response.text(), status=response.status)
+
+    async def _callback_async(self, request):
+        return web.Response(text='', status=200)
+
+    async def _manage_health_async(self, request):
+        return web.Response()
+
+    async def _manage_metrics_async(self, request):
+        return web.json_response(self._get_metrics())
+
+    async def _manage_cache_async(self, request):
+        self._check_admin_token(request.headers)
+
+        prefix = request.query.get('prefix', '')
+
+        purged = 0
+        if self._response_cache is not None:
+            purged = self._response_cache.purge(lambda key: key.startswith(prefix))
+
+        self._logger.info(f'Purged {purged} cached responses with prefix \'{prefix}\'')
+
+        return web.json_response({'purged': purged})
+
+    ################################################################################################
+
+    async def _resend_async(self, service_info, request, cacheable=False):
+        token, headers = await self._run_in_executor(self._authenticate, request)
+
+        path = request.rel_url.raw_path
+        args = dict(request.query)
+
+        if cacheable and request.method == 'GET':
+            return await self._resend_cacheable_async(service_info, path, args, headers)
+
+        if request.method == 'DELETE':
+            data = await request.read()
+        elif request.can_read_body:
+            data = request.content
+        else:
+            data = None
+
+        if request.content_length is None:
+            headers = tools.strip_hop_by_hop_headers(headers, ['Content-Length'])
+
+        try:
+            return await self._stream_async(service_info, request, RequestBackup(path, request.method, headers, args, data))
+
+        except Exception:
+            if request.method == 'DELETE':
+                if await self._run_in_executor(
+                    self._defer_request, service_info, token, RequestBackup(path, request.method, headers, args, data)
+                ):
+                    return web.Response(text='', status=200)
+
+        return web.Response(text='Internal server error', status=500)
+
+    async def _resend_cacheable_async(self, service_info, path, args, headers):
+        key = self._get_cache_key(path, args)
+        headers = self._get_cacheable_headers(headers)
+
+        cached_response = None
+        if self._response_cache is not None:
+            cached_response = self._response_cache.get(key)
+
+        if cached_response is None:
+            try:
+                cached_response = await self._async_single_flight.do(
+                    key, lambda: self._fetch_cacheable_async(key, service_info, path, args, headers)
+                )
+
+            except Exception:
+                return web.Response(text='Internal server error', status=500)
+
+        elif cached_response.fresh_until <= time.time():
+            self._response_cache_stale_hits += 1
+
+            if self._start_revalidation(key):
+                task = asyncio.create_task(self._revalidate_async(key, service_info, path, args, headers))
+                self._revalidation_tasks.add(task)
+                task.add_done_callback(self._revalidation_tasks.discard)
+
+        return web.Response(
+            body=cached_response.body,
+            status=cached_response.status_code,
+            headers=cached_response.headers
+        )
+
+    async def _fetch_cacheable_async(self, key, service_info, path, args, headers):
+        response = await self._request_async(service_info, RequestBackup(path, 'GET', headers, args, None))
+
+        return self._store_cached_response(key, response.status, dict(response.headers), response.body)
+
+    async def _revalidate_async(self, key, service_info, path, args, headers):
+        try:
+            await self._async_single_flight.do(
+                key, lambda: self._fetch_cacheable_async(key, service_info, path, args, headers)
+            )
+
+        except Exception as exception:
+            self._logger.error(f'Failed to revalidate cached \'{key}\', error: {exception}')
+
+        finally:
+            self._finish_revalidation(key)
+
+    async def _request_async(self, service_info, request):
+        endpoint = service_info.acquire_endpoint()
+
+        if endpoint is None:
+            self._logger.error(f'Failed to send request to {service_info.name}, no available endpoints')
+
+            raise RuntimeError('Service is unavailable')
+
+        self._in_flight[service_info.name] = self._in_flight.get(service_info.name, 0) + 1
+
+        try:
+            self._logger.debug(f'Send request to {endpoint.url}')
+            async with self._client_session.request(
+                request.method,
+                f'{endpoint.url}{request.path}',
+                headers=tools.strip_hop_by_hop_headers(request.headers, ['Content-Length']),
+                params=request.args,
+                data=request.data
+            ) as response:
+                body = await response.read()
+
+        except asyncio.CancelledError:
+            endpoint.breaker.record_cancel()
+
+            raise
+
+        except Exception as exception:
+            self._logger.error(f'Failed to send request, error: {exception}')
+            endpoint.breaker.record_failure()
+
+            raise
+
+        finally:
+            self._in_flight[service_info.name] -= 1
+            service_info.release_endpoint(endpoint)
+
+        if response.status in UNAVAILABLE_CODES:
+            endpoint.breaker.record_failure()
+        else:
+            endpoint.breaker.record_success()
+
+        headers = {}
+        if 'Content-Type' in response.headers:
+            headers['Content-Type'] = response.headers['Content-Type']
+
+        return web.Response(body=body, status=response.status, headers=headers)
+
+    async def _stream_async(self, service_info, request, request_backup):
+        endpoint = service_info.acquire_endpoint()
+
+        if endpoint is None:
+            self._logger.error(f'Failed to send request to {service_info.name}, no available endpoints')
+
+            raise RuntimeError('Service is unavailable')
+
+        self._in_flight[service_info.name] = self._in_flight.get(service_info.name, 0) + 1
+
+        try:
+            try:
+                self._logger.debug(f'Send request to {endpoint.url}')
+                response = await self._client_session.request(
+                    request_backup.method,
+                    f'{endpoint.url}{request_backup.path}',
+                    headers=request_backup.headers,
+                    params=request_backup.args,
+                    data=request_backup.data,
+                    auto_decompress=False
+                )
+
+            except asyncio.CancelledError:
+                endpoint.breaker.record_cancel()
+
+                raise
+
+            except Exception as exception:
+                self._logger.error(f'Failed to send request, error: {exception}')
+                endpoint.breaker.record_failure()
+
+                raise
+
+            try:
+                if response.status in UNAVAILABLE_CODES:
+                    endpoint.breaker.record_failure()
+                else:
+                    endpoint.breaker.record_success()
+
+                stream_response = web.StreamResponse(
+                    status=response.status,
+                    headers=tools.strip_hop_by_hop_headers(response.headers, ['Content-Length'])
+                )
+                if response.content_length is not None:
+                    stream_response.content_length = response.content_length
+
+                await stream_response.prepare(request)
+
+                try:
+                    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        await stream_response.write(chunk)
+
+                except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+                    self._logger.error(f'Failed to stream response, error: {exception}')
+
+                    return stream_response
+
+                await stream_response.write_eof()
+
+                return stream_response
+
+            finally:
+                response.release()
+
+        finally:
+            self._in_flight[service_info.name] -= 1
+            service_info.release_endpoint(endpoint)
+
+    # Helpers
+    ####################################################################################################################
+
+    def _authenticate(self, request):
+        token = self._get_user_token(request)
+
+        return token, self._get_forward_headers(request.headers, token)
+
+    async def _run_in_executor(self, func, *args):
+        context = contextvars.copy_context()
+
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, func, *args)
+
+    def _get_request_identity(self):
+        return _request_identity.get()
+
+    def _set_request_identity(self, identity):
+        _request_identity.set(identity)
+
+    @web.middleware
+    async def _handle_errors(self, request, handler):
+        try:
+            return await handler(request)
+
+        except UserError as error:
+            error.message.update({'error': 'bad request'})
+            return web.json_response(error.message, status=error.code)
+
+        except ServerError as error:
+            self._logger.error(f'Server error: {error.message}')
+            return web.json_response(error.message, status=error.code)
+
+    async def _create_client_session(self, app):
+        self._client_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=self._http_client.pool_size),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=self._http_client.connect_timeout_s,
+                sock_read=self._http_client.read_timeout_s
+            ),
+            cookie_jar=aiohttp.DummyCookieJar()
+        )
+
+    async def _close_client_session(self, app):
+        await self._client_session.close()
+
+    def _get_metrics(self):
+        metrics = super()._get_metrics()
+        metrics['async_in_flight'] = dict(self._in_flight)
+        metrics['single_flight'] = self._async_single_flight.stats()
+
+        return metrics
+
+    def _register_async_routes(self):
+        routes = [
+            (['/api/v1/flights', '/api/v1/flights/{path:.+}'], ALL_METHODS, self._flight_async),
+            (['/api/v1/privilege', '/api/v1/privilege/{path:.+}'], ALL_METHODS, self._privilege_async),
+            (['/api/v1/tickets', '/api/v1/tickets/{path:.+}', '/api/v1/me'], ALL_METHODS, self._tickets_async),
+            (['/api/v1/authorize'], ['POST'], self._authorize_async),
+            (['/api/v1/callback'], ALL_METHODS, self._callback_async),
+            (['/manage/health'], ['GET'], self._manage_health_async),
+            (['/manage/metrics'], ['GET'], self._manage_metrics_async),
+            (['/manage/cache'], ['DELETE'], self._manage_cache_async)
+        ]
+
+        for paths, methods, handler in routes:
+            for path in paths:
+                self._logger.info(f'Register async route for \'{path}\' with methods: {methods}')
+
+                for method in methods:
+                    self._web_app.router.add_route(method, path, handler)
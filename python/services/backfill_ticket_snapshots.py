@@ -0,0 +1,77 @@
+import logging
+
+from ticket import TicketDbConnector
+from flight import FlightDbConnector
+
+import tools
+
+import argparse
+
+
+BATCH_SIZE = 500
+
+
+def backfill_ticket_snapshots(ticket_db_connector, flight_db_connector, batch_size=BATCH_SIZE):
+    logger = logging.getLogger('BackfillTicketSnapshots')
+
+    numbers = ticket_db_connector.get_flight_numbers_without_snapshot()
+    logger.info(f'Found {len(numbers)} flights referenced by tickets without snapshot')
+
+    updated = 0
+    for begin in range(0, len(numbers), batch_size):
+        flights = flight_db_connector.get_flights_by_numbers(numbers[begin:begin + batch_size])
+
+        for flight in flights:
+            updated += ticket_db_connector.set_flight_snapshot(
+                flight['number'], flight['from_airport'], flight['to_airport'], flight['datetime']
+            )
+
+        missed = set(numbers[begin:begin + batch_size]) - set(flight['number'] for flight in flights)
+        if len(missed) != 0:
+            logger.warning(f'Flights not found, tickets left without snapshot: {sorted(missed)}')
+
+    logger.info(f'Updated {updated} tickets')
+
+    return updated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticket-db-host', type=str, default='localhost')
+    parser.add_argument('--ticket-db-port', type=int, default=5432)
+    parser.add_argument('--ticket-db', type=str, default='tickets')
+    parser.add_argument('--flight-db-host', type=str, default='localhost')
+    parser.add_argument('--flight-db-port', type=int, default=5432)
+    parser.add_argument('--flight-db', type=str, default='flights')
+    parser.add_argument('--db-user', type=str, required=True)
+    parser.add_argument('--db-password', type=str, required=True)
+    parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--debug', action='store_true')
+
+    cmd_args = parser.parse_args()
+
+    if cmd_args.debug:
+        tools.set_basic_logging_config(level=logging.DEBUG)
+    else:
+        tools.set_basic_logging_config(level=logging.INFO)
+
+    backfill_ticket_snapshots(
+        TicketDbConnector(
+            cmd_args.ticket_db_host,
+            cmd_args.ticket_db_port,
+            cmd_args.ticket_db,
+            cmd_args.db_user,
+            cmd_args.db_password,
+            cmd_args.db_sslmode
+        ),
+        FlightDbConnector(
+            cmd_args.flight_db_host,
+            cmd_args.flight_db_port,
+            cmd_args.flight_db,
+            cmd_args.db_user,
+            cmd_args.db_password,
+            cmd_args.db_sslmode
+        ),
+        cmd_args.batch_size
+    )
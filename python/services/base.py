@@ -1,62 +1,498 @@
 from flask import Flask
 from flask import make_response
+from flask import g
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import EmptyPoolError
 
 import logging
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 
 from errors import UserError
+from errors import ServerError
 from getters import ServerValue, UserValue
 import rules
+import tools
+from cache import TtlLruCache, SingleFlight
 
 from datetime import datetime
+from contextlib import contextmanager
 import time
+import threading
+import hashlib
+import hmac
+import base64
+import json
+import re
+import uuid
+
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
 
 from jose import jwt
+from jose import jwk
 
-class DbConnectorBase:
-    def __init__(self, name, host, port, database, user, password, sslmode):
+psycopg2.extensions.register_adapter(uuid.UUID, psycopg2.extras.UUID_adapter)
+
+
+class StatementConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.prepared_statements = set()
+
+
+class PreparedStatement:
+    def __init__(self, name, query):
+        self.name = name
+        self.query = tools.simplify_sql_query(query)
+
+        params_number = max([int(number) for number in re.findall(r'\$(\d+)', self.query)], default=0)
+
+        self.prepare_query = f'PREPARE {name} AS {self.query}'
+
+        if params_number == 0:
+            self.execute_query = f'EXECUTE {name}'
+        else:
+            self.execute_query = f'EXECUTE {name}({", ".join(["%s"] * params_number)})'
+
+
+class ConnectionPool:
+    def __init__(self, name, connect, min_size=1, max_size=10, checkout_timeout_s=5, health_check_idle_s=30):
         self._logger = logging.getLogger(name)
 
-        self._connection = self.create_connection(host, port, database, user, password, sslmode)
+        self._connect = connect
+        self._min_size = min_size
+        self._max_size = max_size
+        self._checkout_timeout_s = checkout_timeout_s
+        self._health_check_idle_s = health_check_idle_s
+
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.broken = 0
+        self.wait_time_s = 0
+        self.max_wait_time_s = 0
+
+    def fill(self):
+        while True:
+            with self._condition:
+                if self._size >= self._min_size:
+                    return
+
+                self._size += 1
+
+            try:
+                connection = self._open()
+
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+
+                raise
+
+            with self._condition:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+
+        try:
+            yield connection
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.release(connection, broken=True)
+            raise
+
+        except BaseException:
+            self.release(connection)
+            raise
+
+        self.release(connection)
+
+    def acquire(self):
+        start_time = time.monotonic()
+        deadline = start_time + self._checkout_timeout_s
+
+        while True:
+            with self._condition:
+                while len(self._idle) == 0 and self._size >= self._max_size:
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0 or not self._condition.wait(remaining):
+                        if len(self._idle) == 0 and self._size >= self._max_size:
+                            self.timeouts += 1
+                            self._logger.warning(f'Connection checkout timed out after {self._checkout_timeout_s} s')
+                            raise ServerError({'error': 'database is busy'}, 503)
+
+                if len(self._idle) != 0:
+                    connection, idle_since = self._idle.pop()
+                else:
+                    connection, idle_since = None, None
+                    self._size += 1
+
+            if connection is None:
+                try:
+                    connection = self._open()
+
+                except Exception as exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+
+                    self._logger.error(f'Failed to open database connection, error: {exception}')
+                    raise ServerError({'error': 'database is unavailable'}, 503)
+
+            elif not self._is_healthy(connection, idle_since):
+                self._discard(connection)
+                continue
+
+            wait_time_s = time.monotonic() - start_time
+
+            with self._condition:
+                self.checkouts += 1
+                self.wait_time_s += wait_time_s
+                self.max_wait_time_s = max(self.max_wait_time_s, wait_time_s)
+
+            return connection
+
+    def release(self, connection, broken=False):
+        if not broken and connection.closed == 0:
+            try:
+                if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+
+        if broken or connection.closed != 0:
+            self._discard(connection)
+            return
+
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self._min_size,
+                'max_size': self._max_size,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'broken': self.broken,
+                'wait_time_s': self.wait_time_s,
+                'avg_wait_time_s': self.wait_time_s / self.checkouts if self.checkouts != 0 else 0,
+                'max_wait_time_s': self.max_wait_time_s
+            }
+
+    def _open(self):
+        connection = self._connect()
+        self._logger.debug(f'Opened database connection, pool size: {self._size}')
+
+        return connection
+
+    def _is_healthy(self, connection, idle_since):
+        if connection.closed != 0:
+            return False
+
+        if time.monotonic() - idle_since < self._health_check_idle_s:
+            return True
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.rollback()
+
+            return True
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as exception:
+            self._logger.warning(f'Drop broken database connection, error: {exception}')
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+
+        except Exception:
+            pass
+
+        with self._condition:
+            self._size -= 1
+            self.broken += 1
+            self._condition.notify()
+
+
+class DbConnectorBase:
+    STATEMENTS = {}
+
+    def __init__(
+        self,
+        name,
+        host,
+        port,
+        database,
+        user,
+        password,
+        sslmode,
+        pool_min_size=1,
+        pool_max_size=10,
+        pool_checkout_timeout_s=5,
+        pool_health_check_idle_s=30
+    ):
+        self._logger = logging.getLogger(name)
 
-    def create_connection(self, host, port, database, user, password, sslmode, retry_number=10, reconnecting_delay_s=1):
         self._logger.info(
-            f'Create connection on \'http://{host}:{port}\' to database \'{database}\' under user \'{user}\''
+            f'Create connection pool on \'http://{host}:{port}\' to database \'{database}\' under user \'{user}\', '
+            f'size: {pool_min_size}..{pool_max_size}'
         )
 
-        for i in range(retry_number):
-            try:
-                return psycopg2.connect(
-                    host=host,
-                    port=port,
-                    database=database,
-                    user=user,
-                    password=password,
-                    sslmode=sslmode
-                )
-            except Exception as exception:
-                error = exception.args[0].replace('\n', ' ').strip()
-                if error.find('Connection refused'):
-                    logging.debug(f'Got error {error}, reconnecting in {reconnecting_delay_s} seconds')
-                    time.sleep(reconnecting_delay_s)
-        
-        raise RuntimeError('Connection to database failed')
+        self._connect = lambda **kwargs: psycopg2.connect(
+            host=host,
+            port=port,
+            database=database,
+            user=user,
+            password=password,
+            sslmode=sslmode,
+            connection_factory=StatementConnection,
+            **kwargs
+        )
+
+        self._pool = ConnectionPool(
+            f'{name}.ConnectionPool',
+            self._connect,
+            pool_min_size,
+            pool_max_size,
+            pool_checkout_timeout_s,
+            pool_health_check_idle_s
+        )
+
+        try:
+            self._pool.fill()
+
+        except Exception as exception:
+            error = str(exception).replace('\n', ' ').strip()
+            self._logger.warning(f'Failed to open initial connections, will retry on demand, error: {error}')
+
+        self._statements = {
+            name: PreparedStatement(name, query) for name, query in self.STATEMENTS.items()
+        }
+
+    def connect(self, **kwargs):
+        return self._connect(**kwargs)
+
+    def _connection(self):
+        return self._pool.connection()
+
+    def _execute(self, cursor, name, *params):
+        statement = self._statements[name]
+        connection = cursor.connection
+
+        if name not in connection.prepared_statements:
+            self._logger.debug(f'Prepare statement: {statement.prepare_query}')
+            cursor.execute(statement.prepare_query)
+            connection.prepared_statements.add(name)
+
+        self._logger.debug(f'Execute statement \'{name}\' with params: {params}')
+        cursor.execute(statement.execute_query, params)
+
+    def _fetch_one(self, name, *params):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, name, *params)
+
+            row = cursor.fetchone()
+            cursor.close()
+
+        return row
+
+    def _fetch_all(self, name, *params):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, name, *params)
+
+            table = cursor.fetchall()
+            cursor.close()
+
+        return table
+
+    def _modify(self, name, *params):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, name, *params)
+
+            row_count = cursor.rowcount
+            cursor.close()
+            connection.commit()
+
+        return row_count
+
+    def stats(self):
+        return self._pool.stats()
+
+
+class BoundedHTTPAdapter(HTTPAdapter):
+    def __init__(self, pool_timeout_s, *args, **kwargs):
+        self._pool_timeout_s = pool_timeout_s
+
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: BoundedHTTPAdapter._with_pool_timeout(pool_class, self._pool_timeout_s)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    @staticmethod
+    def _with_pool_timeout(pool_class, pool_timeout_s):
+        class BoundedPool(pool_class):
+            def _get_conn(self, timeout=None):
+                return super()._get_conn(pool_timeout_s if timeout is None else timeout)
+
+        return BoundedPool
+
+
+class HttpClient:
+    def __init__(
+        self,
+        name,
+        pool_size=10,
+        connect_timeout_s=3,
+        read_timeout_s=10,
+        max_downstreams=32,
+        pool_timeout_s=5
+    ):
+        self._logger = logging.getLogger(name)
+
+        self._timeout = (connect_timeout_s, read_timeout_s)
+
+        self._adapter = BoundedHTTPAdapter(
+            pool_timeout_s,
+            pool_connections=max_downstreams,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=0
+        )
+
+        self._session = requests.Session()
+        self._session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+        self.pool_size = pool_size
+        self.connect_timeout_s = connect_timeout_s
+        self.read_timeout_s = read_timeout_s
+        self.pool_timeout_s = pool_timeout_s
+
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._waits = {}
+        self._pool_timeouts = {}
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+
+        downstream = urlsplit(url).netloc
+        pool = self._adapter.poolmanager.connection_from_url(url)
+
+        with self._lock:
+            self._requests[downstream] = self._requests.get(downstream, 0) + 1
+
+            if pool.pool is not None and pool.pool.empty():
+                self._waits[downstream] = self._waits.get(downstream, 0) + 1
+                self._logger.debug(f'Connection pool for \'{downstream}\' is exhausted, wait for connection')
+
+        try:
+            return self._session.request(method, url, **kwargs)
+
+        except EmptyPoolError:
+            with self._lock:
+                self._pool_timeouts[downstream] = self._pool_timeouts.get(downstream, 0) + 1
+
+            self._logger.error(
+                f'No connection to \'{downstream}\' became free in {self.pool_timeout_s} s, reject request'
+            )
+
+            raise ServerError({'error': f'{downstream} is busy'}, 503)
+
+    def stats(self):
+        stats = {}
+
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+
+            if pool is None or pool.pool is None:
+                continue
+
+            downstream = f'{pool.host}:{pool.port}'
+            if pool.port in (None, 80, 443):
+                downstream = pool.host
+
+            idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+
+            stats[downstream] = {
+                'pool_size': self.pool_size,
+                'in_use': self.pool_size - pool.pool.qsize(),
+                'idle': idle,
+                'requests': self._requests.get(downstream, 0),
+                'waits': self._waits.get(downstream, 0),
+                'pool_timeouts': self._pool_timeouts.get(downstream, 0)
+            }
+
+        return stats
+
+
 class ServiceBase:
-    def __init__(self, name, host, port, db_connector:DbConnectorBase=None):
+    ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+    def __init__(
+        self,
+        name,
+        host,
+        port,
+        db_connector:DbConnectorBase=None,
+        http_pool_size=10,
+        http_connect_timeout_s=3,
+        http_read_timeout_s=10,
+        http_pool_timeout_s=5,
+        admin_token=None
+    ):
         self._service_name = name
+        self._admin_token = admin_token
 
         self._host = host
         self._port = port
         self._db_connector = db_connector
 
+        self._http_client = HttpClient(
+            f'{self._service_name} http client',
+            http_pool_size,
+            http_connect_timeout_s,
+            http_read_timeout_s,
+            pool_timeout_s=http_pool_timeout_s
+        )
+
         self._flask_app = Flask(f'{self._service_name} flask')
 
         self._logger = logging.getLogger(self._service_name)
 
         self._register_manage_health()
+        self._register_manage_metrics()
         self._register_routes()
 
     def run(self, debug=False):
@@ -83,6 +519,13 @@ class ServiceBase:
 
     def _manage_health(self):
         return make_response()
+
+    def _check_admin_token(self, headers):
+        if self._admin_token is None:
+            raise UserError({'message': 'management endpoint is disabled'}, 403)
+
+        if not hmac.compare_digest(headers.get(ServiceBase.ADMIN_TOKEN_HEADER, ''), self._admin_token):
+            raise UserError({'message': 'invalid admin token'}, 401)
     
     def _register_manage_health(self):
         path = '/manage/health'
@@ -96,6 +539,31 @@ class ServiceBase:
             methods=methods
         )
 
+    def _manage_metrics(self):
+        return make_response(self._get_metrics(), 200)
+
+    def _register_manage_metrics(self):
+        path = '/manage/metrics'
+        methods = ['GET']
+
+        self._logger.info(f'Register route for \'{path}\' with methods: {methods}')
+
+        self._flask_app.add_url_rule(
+            path,
+            view_func=self._manage_metrics,
+            methods=methods
+        )
+
+    def _get_metrics(self):
+        metrics = {
+            'http_client': self._http_client.stats()
+        }
+
+        if self._db_connector is not None:
+            metrics['db_pool'] = self._db_connector.stats()
+
+        return metrics
+
     def _register_routes(self):
         pass
 
@@ -127,6 +595,10 @@ class ServiceBase:
                     error.message.update({'error': 'bad request'})
                     return make_response(error.message, error.code)
 
+                except ServerError as error:
+                    self._logger.error(f'Server error: {error.message}')
+                    return make_response(error.message, error.code)
+
             setattr(wrapper, 'path', path)
             setattr(wrapper, 'methods', methods)
 
@@ -143,6 +615,137 @@ class AuthorizeServiceInfo:
         self.url = f'https://{url}'
 
 
+class JwksKeyStore:
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance(url, http_client, ttl_s=600, min_refetch_interval_s=30):
+        with JwksKeyStore._instances_lock:
+            if url not in JwksKeyStore._instances:
+                JwksKeyStore._instances[url] = JwksKeyStore(url, http_client, ttl_s, min_refetch_interval_s)
+
+            return JwksKeyStore._instances[url]
+
+    def __init__(self, url, http_client, ttl_s=600, min_refetch_interval_s=30):
+        self._logger = logging.getLogger('JwksKeyStore')
+
+        self._url = url
+        self._http_client = http_client
+        self._ttl_s = ttl_s
+        self._min_refetch_interval_s = min_refetch_interval_s
+
+        self._keys = {}
+        self._fetch_lock = threading.Lock()
+        self._last_fetch_time = None
+
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, name='JwksKeyStore', daemon=True)
+        self._refresh_thread.start()
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+
+        if key is None:
+            self._logger.debug(f'Unknown kid \'{kid}\', try to refetch keys')
+            self._refetch()
+
+            key = self._keys.get(kid)
+
+        return key
+
+    def _refetch(self):
+        with self._fetch_lock:
+            if self._last_fetch_time is not None:
+                if time.monotonic() - self._last_fetch_time < self._min_refetch_interval_s:
+                    return False
+
+            return self._fetch()
+
+    def _fetch(self):
+        self._last_fetch_time = time.monotonic()
+
+        try:
+            response = self._http_client.request('GET', self._url)
+            response.raise_for_status()
+
+            keys = {}
+            for key in response.json()['keys']:
+                if key.get('kty') != 'RSA':
+                    continue
+
+                keys[key['kid']] = jwk.construct(
+                    {
+                        'kty': key['kty'],
+                        'kid': key['kid'],
+                        'use': key.get('use', 'sig'),
+                        'n': key['n'],
+                        'e': key['e']
+                    },
+                    'RS256'
+                )
+
+        except Exception as exception:
+            self._logger.warning(
+                f'Failed to fetch keys from \'{self._url}\', keep {len(self._keys)} last known keys, error: {exception}'
+            )
+
+            return False
+
+        self._logger.debug(f'Fetched {len(keys)} keys from \'{self._url}\'')
+        self._keys = keys
+
+        return True
+
+    def _refresh_loop(self):
+        while True:
+            with self._fetch_lock:
+                fetched = self._fetch()
+
+            time.sleep(self._ttl_s if fetched else self._min_refetch_interval_s)
+
+
+class InternalIdentitySigner:
+    HEADER = 'X-Internal-Identity'
+
+    def __init__(self, secret, ttl_s=60):
+        self._secret = secret.encode()
+        self._ttl_s = ttl_s
+
+    def sign(self, username, expire_time=None):
+        max_expire_time = int(time.time()) + self._ttl_s
+
+        if expire_time is None or expire_time > max_expire_time:
+            expire_time = max_expire_time
+
+        payload = base64.urlsafe_b64encode(
+            json.dumps({'username': username, 'exp': int(expire_time)}, separators=(',', ':')).encode()
+        ).decode()
+
+        return f'{payload}.{self._signature(payload)}'
+
+    def verify(self, value):
+        if not value or value.count('.') != 1:
+            return None
+
+        payload, signature = value.split('.')
+
+        if not hmac.compare_digest(signature, self._signature(payload)):
+            return None
+
+        try:
+            identity = json.loads(base64.urlsafe_b64decode(payload))
+        except ValueError:
+            return None
+
+        if identity['exp'] <= time.time():
+            return None
+
+        return identity
+
+    def _signature(self, payload):
+        return hmac.new(self._secret, payload.encode(), hashlib.sha256).hexdigest()
+
+
 class ServerBaseWithAuth0(ServiceBase):
     def __init__(
         self,
@@ -150,6 +753,15 @@ class ServerBaseWithAuth0(ServiceBase):
         authorize_service_secret_key, 
         authorize_service_url,
         *args,
+        jwks_ttl_s=600,
+        jwks_min_refetch_interval_s=30,
+        token_cache_size=1024,
+        username_claim='nickname',
+        username_cache_size=1024,
+        username_cache_ttl_s=300,
+        identity_secret=None,
+        identity_ttl_s=60,
+        trust_internal_identity=False,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
@@ -159,22 +771,109 @@ class ServerBaseWithAuth0(ServiceBase):
             authorize_service_secret_key, 
             authorize_service_url
         )
-    
+
+        self._jwks_key_store = JwksKeyStore.get_instance(
+            f'{self._authorize_service_info.url}/.well-known/jwks.json',
+            self._http_client,
+            jwks_ttl_s,
+            jwks_min_refetch_interval_s
+        )
+
+        self._token_cache = TtlLruCache(token_cache_size)
+        self._token_verifications = 0
+        self._token_verify_time_s = 0
+
+        self._username_claim = username_claim
+        self._username_cache = TtlLruCache(username_cache_size, username_cache_ttl_s)
+        self._userinfo_single_flight = SingleFlight()
+
+        self._identity_signer = None
+        if identity_secret is not None:
+            self._identity_signer = InternalIdentitySigner(identity_secret, identity_ttl_s)
+
+        if trust_internal_identity and self._identity_signer is None:
+            raise RuntimeError('Trusted internal identity requires identity secret')
+
+        self._trust_internal_identity = trust_internal_identity
+        self._trusted_identities = 0
+
     def _get_user_token(self, request):
-        token = UserValue.get_from(request.headers, 'Authorization', code=401).value
-        token = token.split()
+        if self._trust_internal_identity:
+            identity = self._identity_signer.verify(request.headers.get(InternalIdentitySigner.HEADER))
 
-        if len(token) > 1:
-            token = token[1]
-        else:
-            token = token[0]
+            if identity is not None:
+                self._trusted_identities += 1
+                self._set_request_identity(identity)
+
+                if 'Authorization' not in request.headers:
+                    return None # replayed request, identity is the only credential
+
+                return ServerBaseWithAuth0._parse_bearer_token(request.headers['Authorization'])
+
+        token = ServerBaseWithAuth0._parse_bearer_token(
+            UserValue.get_from(request.headers, 'Authorization', code=401).value
+        )
 
         self._validate_token(token)
 
         return token
 
+    @staticmethod
+    def _parse_bearer_token(value):
+        token = value.split()
+
+        if len(token) > 1:
+            return token[1]
+
+        return token[0]
+
+    def _get_auth_headers(self, token):
+        headers = {}
+        if token is not None:
+            headers['Authorization'] = f'Bearer {token}'
+
+        if self._identity_signer is None:
+            return headers
+
+        identity = self._get_request_identity()
+
+        if identity is None:
+            identity = {
+                'username': self._get_username(token),
+                'exp': self._validate_token(token).get('exp')
+            }
+
+        headers[InternalIdentitySigner.HEADER] = self._identity_signer.sign(identity['username'], identity['exp'])
+
+        return headers
+
+    def _get_request_identity(self):
+        return g.get('internal_identity')
+
+    def _set_request_identity(self, identity):
+        g.internal_identity = identity
+
     def _get_username(self, token):
-        response = requests.request(
+        identity = self._get_request_identity()
+        if identity is not None:
+            return identity['username']
+
+        claims = self._validate_token(token)
+
+        username = claims.get(self._username_claim)
+        if username is not None:
+            return username
+
+        subject = ServerValue.get_from(claims, 'sub', code=401).value
+
+        username = self._username_cache.get(subject)
+        if username is not None:
+            return username
+
+        return self._userinfo_single_flight.do(subject, lambda: self._fetch_username(subject, token))
+
+    def _fetch_username(self, subject, token):
+        response = self._http_client.request(
             'GET',
             f'{self._authorize_service_info.url}/userinfo',
             headers={
@@ -183,26 +882,30 @@ class ServerBaseWithAuth0(ServiceBase):
         )
 
         # ServerValue.get_from(response.headers, 'Content-Type').rule(rules.json_content)
-        return ServerValue.get_from(response.json(), 'nickname').value
+        username = ServerValue.get_from(response.json(), 'nickname').value
+
+        self._username_cache.put(subject, username)
+
+        return username
 
     def _validate_token(self, token):
-        rsa_key = None
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
 
-        try:
-            jwks = requests.request('GET', f'{self._authorize_service_info.url}/.well-known/jwks.json').json()
-            unverified_header = jwt.get_unverified_header(token)
+        claims = self._token_cache.get(token_hash)
+        if claims is not None:
+            return claims
 
-            for key in jwks['keys']:
-                if key['kid'] == unverified_header['kid']:
-                    rsa_key = {
-                        "kty": key["kty"],
-                        "kid": key["kid"],
-                        "use": key["use"],
-                        "n": key["n"],
-                        "e": key["e"]
-                    }
+        claims = self._verify_token(token)
 
-                    break
+        if 'exp' in claims:
+            self._token_cache.put(token_hash, claims, claims['exp'])
+
+        return claims
+
+    def _verify_token(self, token):
+        try:
+            unverified_header = jwt.get_unverified_header(token)
+            rsa_key = self._jwks_key_store.get_key(unverified_header['kid'])
 
         except Exception as error:
             raise UserError(
@@ -210,6 +913,8 @@ class ServerBaseWithAuth0(ServiceBase):
                 )
 
         if rsa_key is not None:
+            start_time = time.perf_counter()
+
             try:
                 return jwt.decode(
                     token,
@@ -227,7 +932,25 @@ class ServerBaseWithAuth0(ServiceBase):
                 raise UserError(
                     {'message': f'invalid header, {error}'}, 401
                 )
+
+            finally:
+                self._token_verifications += 1
+                self._token_verify_time_s += time.perf_counter() - start_time
         
         raise UserError(
             {'message': 'invalid header'}, 401
-        )
\ No newline at end of file
+        )
+
+    def _get_metrics(self):
+        metrics = super()._get_metrics()
+
+        token_cache = self._token_cache.stats()
+        token_cache['verifications'] = self._token_verifications
+        token_cache['verify_time_s'] = self._token_verify_time_s
+
+        metrics['token_cache'] = token_cache
+        metrics['username_cache'] = self._username_cache.stats()
+        metrics['userinfo_requests'] = self._userinfo_single_flight.stats()
+        metrics['trusted_identities'] = self._trusted_identities
+
+        return metrics
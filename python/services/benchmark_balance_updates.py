@@ -0,0 +1,223 @@
+import logging
+
+from bonus import BonusDbConnector
+
+import tools
+
+import psycopg2
+
+import argparse
+import statistics
+import threading
+import time
+import uuid
+
+
+USERNAME_PREFIX = 'benchmark_balance_'
+
+
+class LegacyBalanceUpdater:
+    def __init__(self, connect):
+        self._local = threading.local()
+        self._connect = connect
+
+    def update_user_balance(self, user, ticket_uid, datetime, balance_diff, operation_type):
+        connection = self._get_connection()
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, balance FROM privilege WHERE username = %s', (user, ))
+            privilege_id, balance = cursor.fetchone()
+            connection.commit()
+
+            if operation_type == 'DEBIT_THE_ACCOUNT':
+                balance -= balance_diff
+            else:
+                balance += balance_diff
+
+            cursor.execute(
+                tools.simplify_sql_query(
+                    'START TRANSACTION; '
+                    'UPDATE privilege SET balance = %s WHERE id = %s; '
+                    'INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+                    'VALUES(%s, %s, %s, %s, %s); '
+                    'COMMIT;'
+                ),
+                (balance, privilege_id, privilege_id, ticket_uid, datetime, balance_diff, operation_type)
+            )
+
+            cursor.execute('SELECT status, balance FROM privilege WHERE username = %s', (user, ))
+            status, balance = cursor.fetchone()
+            connection.commit()
+
+        return {
+            'status': status,
+            'balance': balance
+        }
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+
+        return connection
+
+
+class BalanceUpdateBenchmark:
+    def __init__(self, db_connector, connect, users, threads, purchases, balance_diff):
+        self._logger = logging.getLogger('BalanceUpdateBenchmark')
+
+        self._db_connector = db_connector
+        self._connect = connect
+        self._usernames = [f'{USERNAME_PREFIX}{i}' for i in range(users)]
+        self._threads = threads
+        self._purchases = purchases
+        self._balance_diff = balance_diff
+
+    def run(self):
+        return [
+            self._run_mode('legacy', LegacyBalanceUpdater(self._connect)),
+            self._run_mode('single statement', self._db_connector)
+        ]
+
+    def _run_mode(self, mode, updater):
+        self._reset_users()
+
+        latencies = []
+        failures = []
+        lock = threading.Lock()
+
+        def purchase(thread_number):
+            thread_latencies = []
+
+            for i in range(self._purchases):
+                username = self._usernames[(thread_number + i) % len(self._usernames)]
+
+                begin = time.perf_counter()
+                try:
+                    updater.update_user_balance(
+                        username, str(uuid.uuid4()), '2021-10-08 20:00:00', self._balance_diff, 'FILL_IN_BALANCE'
+                    )
+
+                except Exception as exception:
+                    with lock:
+                        failures.append(str(exception))
+                    continue
+
+                thread_latencies.append((time.perf_counter() - begin) * 1000)
+
+            with lock:
+                latencies.extend(thread_latencies)
+
+        self._logger.info(f'Running {self._threads} x {self._purchases} purchases in {mode} mode')
+
+        threads = [threading.Thread(target=purchase, args=(i, )) for i in range(self._threads)]
+
+        begin = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - begin
+
+        expected_balance = len(latencies) * self._balance_diff
+        actual_balance = sum(self._get_balances().values())
+
+        return {
+            'mode': mode,
+            'purchases': len(latencies),
+            'failures': len(failures),
+            'throughput': len(latencies) / elapsed,
+            'latencies': latencies,
+            'expected_balance': expected_balance,
+            'actual_balance': actual_balance
+        }
+
+    def _reset_users(self):
+        self.cleanup()
+
+        for username in self._usernames:
+            self._db_connector.add_user_privilege(username)
+
+    def _get_balances(self):
+        return {username: self._db_connector.get_user_privilege(username)['balance'] for username in self._usernames}
+
+    def cleanup(self):
+        connection = self._connect()
+
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'DELETE FROM privilege_history WHERE privilege_id IN '
+                        '(SELECT id FROM privilege WHERE username LIKE %s)',
+                        (f'{USERNAME_PREFIX}%', )
+                    )
+                    cursor.execute('DELETE FROM privilege WHERE username LIKE %s', (f'{USERNAME_PREFIX}%', ))
+        finally:
+            connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-host', type=str, default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--db', type=str, default='privileges')
+    parser.add_argument('--db-user', type=str, required=True)
+    parser.add_argument('--db-password', type=str, required=True)
+    parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--purchases', type=int, default=200)
+    parser.add_argument('--balance-diff', type=int, default=150)
+    parser.add_argument('--debug', action='store_true')
+
+    cmd_args = parser.parse_args()
+
+    if cmd_args.debug:
+        tools.set_basic_logging_config(level=logging.DEBUG)
+    else:
+        tools.set_basic_logging_config(level=logging.INFO)
+
+    benchmark = BalanceUpdateBenchmark(
+        BonusDbConnector(
+            cmd_args.db_host,
+            cmd_args.db_port,
+            cmd_args.db,
+            cmd_args.db_user,
+            cmd_args.db_password,
+            cmd_args.db_sslmode,
+            pool_max_size=cmd_args.threads
+        ),
+        lambda: psycopg2.connect(
+            host=cmd_args.db_host,
+            port=cmd_args.db_port,
+            database=cmd_args.db,
+            user=cmd_args.db_user,
+            password=cmd_args.db_password,
+            sslmode=cmd_args.db_sslmode
+        ),
+        cmd_args.users,
+        cmd_args.threads,
+        cmd_args.purchases,
+        cmd_args.balance_diff
+    )
+
+    try:
+        results = benchmark.run()
+    finally:
+        benchmark.cleanup()
+
+    print(
+        f'{"mode":<18} {"purchases":>9} {"failures":>8} {"rps":>9} {"p50, ms":>9} {"p95, ms":>9} '
+        f'{"expected":>10} {"actual":>10} {"lost":>6}'
+    )
+    for result in results:
+        latencies = sorted(result['latencies'])
+        print(
+            f'{result["mode"]:<18} {result["purchases"]:>9} {result["failures"]:>8} {result["throughput"]:>9.1f} '
+            f'{statistics.median(latencies):>9.3f} {latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]:>9.3f} '
+            f'{result["expected_balance"]:>10} {result["actual_balance"]:>10} '
+            f'{(result["expected_balance"] - result["actual_balance"]) // cmd_args.balance_diff:>6}'
+        )
@@ -0,0 +1,305 @@
+import logging
+
+from base import PreparedStatement
+from flight import FlightDbConnector
+from ticket import TicketDbConnector
+from bonus import BonusDbConnector
+from migrate import MigrationRunner
+from migrate import get_default_migrations_dir
+
+import tools
+
+import psycopg2
+
+import argparse
+import random
+import statistics
+import time
+
+
+SCHEMA = 'benchmark'
+
+BASELINE_SCHEMAS = {
+    'flights': [
+        'CREATE TABLE airport ( '
+        '    id      SERIAL PRIMARY KEY, '
+        '    name    VARCHAR(255), '
+        '    city    VARCHAR(255), '
+        '    country VARCHAR(255) '
+        ')',
+        'CREATE TABLE flight ( '
+        '    id              SERIAL PRIMARY KEY, '
+        '    number          VARCHAR(20)              NOT NULL, '
+        '    datetime        TIMESTAMP WITH TIME ZONE NOT NULL, '
+        '    from_airport_id INT REFERENCES airport (id), '
+        '    to_airport_id   INT REFERENCES airport (id), '
+        '    price           INT                      NOT NULL '
+        ')'
+    ],
+    'tickets': [
+        'CREATE TABLE ticket ( '
+        '    id            SERIAL PRIMARY KEY, '
+        '    uid           uuid UNIQUE NOT NULL, '
+        '    username      VARCHAR(80) NOT NULL, '
+        '    flight_number VARCHAR(20) NOT NULL, '
+        '    price         INT         NOT NULL, '
+        '    status        VARCHAR(20) NOT NULL CHECK (status IN (\'PAID\', \'CANCELED\')), '
+        '    from_airport  VARCHAR(511), '
+        '    to_airport    VARCHAR(511), '
+        '    flight_date   TIMESTAMP WITH TIME ZONE '
+        ')'
+    ],
+    'privileges': [
+        'CREATE TABLE privilege ( '
+        '    id       SERIAL PRIMARY KEY, '
+        '    username VARCHAR(80) NOT NULL UNIQUE, '
+        '    status   VARCHAR(80) NOT NULL DEFAULT \'BRONZE\' CHECK (status IN (\'BRONZE\', \'SILVER\', \'GOLD\')), '
+        '    balance  INT '
+        ')',
+        'CREATE TABLE privilege_history ( '
+        '    id             SERIAL PRIMARY KEY, '
+        '    privilege_id   INT REFERENCES privilege (id), '
+        '    ticket_uid     uuid        NOT NULL, '
+        '    datetime       TIMESTAMP   NOT NULL, '
+        '    balance_diff   INT         NOT NULL, '
+        '    operation_type VARCHAR(20) NOT NULL CHECK (operation_type IN (\'FILL_IN_BALANCE\', \'DEBIT_THE_ACCOUNT\')) '
+        ')'
+    ]
+}
+
+
+class IndexBenchmark:
+    def __init__(self, host, port, user, password, sslmode, databases, rows, flights, users, iterations):
+        self._logger = logging.getLogger('IndexBenchmark')
+
+        self._host = host
+        self._port = port
+        self._user = user
+        self._password = password
+        self._sslmode = sslmode
+        self._databases = databases
+        self._rows = rows
+        self._flights = flights
+        self._users = users
+        self._iterations = iterations
+
+    def run(self, keep=False):
+        results = []
+
+        for kind, seed, get_cases, statements in [
+            ('flights', self._seed_flights, self._get_flight_cases, FlightDbConnector.STATEMENTS),
+            ('tickets', self._seed_tickets, self._get_ticket_cases, TicketDbConnector.STATEMENTS),
+            ('privileges', self._seed_privileges, self._get_privilege_cases, BonusDbConnector.STATEMENTS)
+        ]:
+            database = self._databases[kind]
+            connection = self._connect(database)
+
+            try:
+                self._create_schema(connection, kind)
+
+                self._logger.info(f'Seeding {database}')
+                seed(connection)
+
+                cases = get_cases(connection)
+
+                before = self._measure(connection, statements, cases)
+
+                self._logger.info(f'Applying migrations to {database}')
+                MigrationRunner(connection, get_default_migrations_dir(kind)).migrate()
+                self._analyze(connection)
+
+                after = self._measure(connection, statements, cases)
+
+                results += [(database, name, before[name], after[name]) for name in before]
+
+            finally:
+                if not keep:
+                    self._drop_schema(connection)
+                connection.close()
+
+        return results
+
+    def _connect(self, database):
+        return psycopg2.connect(
+            host=self._host,
+            port=self._port,
+            database=database,
+            user=self._user,
+            password=self._password,
+            sslmode=self._sslmode,
+            options=f'-c search_path={SCHEMA}'
+        )
+
+    @staticmethod
+    def _create_schema(connection, kind):
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+                cursor.execute(f'CREATE SCHEMA {SCHEMA}')
+
+                for query in BASELINE_SCHEMAS[kind]:
+                    cursor.execute(query)
+
+    @staticmethod
+    def _drop_schema(connection):
+        connection.rollback()
+        connection.autocommit = True
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+
+    @staticmethod
+    def _analyze(connection):
+        connection.autocommit = True
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _seed_flights(self, connection):
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO airport(name, city, country) '
+                    'SELECT \'Airport \' || i, \'City \' || i, \'Country\' FROM generate_series(1, 100) AS i'
+                )
+                cursor.execute(
+                    'INSERT INTO flight(number, datetime, from_airport_id, to_airport_id, price) '
+                    'SELECT \'BF\' || i, now() + i * interval \'1 minute\', 1 + i %% 100, 1 + (i + 1) %% 100, 1000 + i %% 5000 '
+                    'FROM generate_series(1, %s) AS i',
+                    (self._flights, )
+                )
+
+        self._analyze(connection)
+
+    def _seed_tickets(self, connection):
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO ticket(uid, username, flight_number, price, status) '
+                    'SELECT gen_random_uuid(), \'user_\' || (i %% %s), \'BF\' || (1 + i %% %s), 1000 + i %% 5000, \'PAID\' '
+                    'FROM generate_series(1, %s) AS i',
+                    (self._users, self._flights, self._rows)
+                )
+
+        self._analyze(connection)
+
+    def _seed_privileges(self, connection):
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO privilege(username, balance) '
+                    'SELECT \'user_\' || i, 0 FROM generate_series(0, %s - 1) AS i',
+                    (self._users, )
+                )
+                cursor.execute(
+                    'INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+                    'SELECT 1 + i %% %s, gen_random_uuid(), now(), 150, \'FILL_IN_BALANCE\' '
+                    'FROM generate_series(1, %s) AS i',
+                    (self._users, self._rows)
+                )
+
+        self._analyze(connection)
+
+    def _get_flight_cases(self, connection):
+        numbers = [f'BF{random.randint(1, self._flights)}' for _ in range(self._iterations)]
+
+        return {
+            'get_flight_by_number': [(number, ) for number in numbers],
+            'get_flights_by_numbers': [
+                (random.sample(numbers, min(20, len(numbers))), ) for _ in range(self._iterations)
+            ]
+        }
+
+    def _get_ticket_cases(self, connection):
+        usernames = [f'user_{random.randrange(self._users)}' for _ in range(self._iterations)]
+
+        return {
+            'get_user_tickets': [(username, ) for username in usernames],
+            'get_user_tickets_page': [(username, 0, 20) for username in usernames]
+        }
+
+    def _get_privilege_cases(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT ticket_uid FROM privilege_history ORDER BY random() LIMIT %s', (self._iterations, )
+            )
+            ticket_uids = [row[0] for row in cursor.fetchall()]
+
+        return {
+            'get_user_privilege': [(f'user_{random.randrange(self._users)}', ) for _ in range(self._iterations)],
+            'get_privilege_history': [(1 + random.randrange(self._users), ) for _ in range(self._iterations)],
+            'get_privilege_history_by_ticket': [(ticket_uid, ) for ticket_uid in ticket_uids]
+        }
+
+    @staticmethod
+    def _measure(connection, statements, cases):
+        connection.autocommit = True
+        latencies = {}
+
+        with connection.cursor() as cursor:
+            cursor.execute('DEALLOCATE ALL')
+
+            for name, params_list in cases.items():
+                statement = PreparedStatement(name, statements[name])
+                cursor.execute(statement.prepare_query)
+
+                latencies[name] = []
+                for params in params_list:
+                    begin = time.perf_counter()
+                    cursor.execute(statement.execute_query, params)
+                    cursor.fetchall()
+                    latencies[name].append((time.perf_counter() - begin) * 1000)
+
+        return latencies
+
+
+def format_latencies(latencies):
+    ordered = sorted(latencies)
+
+    return (
+        f'{statistics.mean(ordered):9.3f} '
+        f'{ordered[len(ordered) // 2]:9.3f} '
+        f'{ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]:9.3f}'
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-host', type=str, default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--db-user', type=str, required=True)
+    parser.add_argument('--db-password', type=str, required=True)
+    parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--flight-db', type=str, default='flights')
+    parser.add_argument('--ticket-db', type=str, default='tickets')
+    parser.add_argument('--bonus-db', type=str, default='privileges')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--flights', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('--debug', action='store_true')
+
+    cmd_args = parser.parse_args()
+
+    if cmd_args.debug:
+        tools.set_basic_logging_config(level=logging.DEBUG)
+    else:
+        tools.set_basic_logging_config(level=logging.INFO)
+
+    results = IndexBenchmark(
+        cmd_args.db_host,
+        cmd_args.db_port,
+        cmd_args.db_user,
+        cmd_args.db_password,
+        cmd_args.db_sslmode,
+        {'flights': cmd_args.flight_db, 'tickets': cmd_args.ticket_db, 'privileges': cmd_args.bonus_db},
+        cmd_args.rows,
+        cmd_args.flights,
+        cmd_args.users,
+        cmd_args.iterations
+    ).run(cmd_args.keep)
+
+    print(f'{"query":<45} {"before, ms (mean p50 p95)":>29}   {"after, ms (mean p50 p95)":>29}')
+    for database, name, before, after in results:
+        print(f'{database + "." + name:<45} {format_latencies(before):>29}   {format_latencies(after):>29}')
@@ -12,24 +12,66 @@ from flask import request
 from flask import make_response
 
 import argparse
+import uuid
+
+from psycopg2.extras import execute_values
 
 from getters import UserValue
 
 class BonusDbConnector(DbConnectorBase):
-    def __init__(self, host, port, database, user, password, sslmode='disable'):
-        super().__init__('BounsDbConnector', host, port, database, user, password, sslmode)
+    HISTORY_COLUMNS = 'id, privilege_id, ticket_uid, datetime, balance_diff, operation_type'
 
-    def get_user_privilege(self, user):
-        query = tools.simplify_sql_query(
-            f'SELECT id, username, status, balance FROM privilege WHERE username = \'{user}\''
+    STATEMENTS = {
+        'get_user_privilege': 'SELECT id, username, status, balance FROM privilege WHERE username = $1',
+        'lock_user_privilege': 'SELECT id, status, balance FROM privilege WHERE username = $1 FOR UPDATE',
+        'add_user_privilege': (
+            'INSERT INTO privilege(username, status, balance) VALUES($1, \'BRONZE\', 0) ON CONFLICT (username) DO NOTHING'
+        ),
+        'set_privilege_balance': 'UPDATE privilege SET balance = $1 WHERE id = $2',
+        'update_user_balance': (
+            'WITH applied AS ( '
+            '    SELECT 1 FROM privilege_history '
+            '    JOIN privilege ON privilege.id = privilege_history.privilege_id '
+            '    WHERE privilege.username = $1 AND privilege_history.ticket_uid = $3::uuid '
+            '), updated AS ( '
+            '    UPDATE privilege SET balance = balance + $2 '
+            '    WHERE username = $1 AND balance + $2 >= 0 AND NOT EXISTS (SELECT 1 FROM applied) '
+            '    RETURNING id, status, balance '
+            '), history AS ( '
+            '    INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+            '    SELECT id, $3::uuid, $4::timestamp, $5::int, $6::varchar FROM updated '
+            ') '
+            'SELECT status, balance, true FROM updated '
+            'UNION ALL '
+            'SELECT status, balance, true FROM privilege WHERE username = $1 AND EXISTS (SELECT 1 FROM applied) '
+            'UNION ALL '
+            'SELECT status, balance, false FROM privilege '
+            'WHERE username = $1 AND NOT EXISTS (SELECT 1 FROM applied) AND NOT EXISTS (SELECT 1 FROM updated)'
+        ),
+        'get_privilege_history': f'SELECT {HISTORY_COLUMNS} FROM privilege_history WHERE privilege_id = $1',
+        'get_privilege_history_by_ticket': f'SELECT {HISTORY_COLUMNS} FROM privilege_history WHERE ticket_uid = $1',
+        'get_privilege_history_by_tickets': (
+            'SELECT ticket_uid, balance_diff, operation_type FROM privilege_history '
+            'WHERE privilege_id = $1 AND ticket_uid = ANY($2) ORDER BY id'
         )
+    }
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+    def __init__(self, host, port, database, user, password, sslmode='disable', **kwargs):
+        super().__init__('BounsDbConnector', host, port, database, user, password, sslmode, **kwargs)
 
-        row = cursor.fetchone()
-        cursor.close()
+    @staticmethod
+    def _make_history(row):
+        return {
+            'id': row[0],
+            'privilege_id': row[1],
+            'ticket_uid': row[2],
+            'datetime': row[3],
+            'balance_diff': row[4],
+            'operation_type': row[5]
+        }
+
+    def get_user_privilege(self, user):
+        row = self._fetch_one('get_user_privilege', user)
 
         if row is None:
             return None
@@ -42,109 +84,164 @@ class BonusDbConnector(DbConnectorBase):
         }
     
     def add_user_privilege(self, user):
-        query = tools.simplify_sql_query(
-            f'INSERT INTO privilege(username, status, balance) VALUES(\'{user}\', \'BRONZE\', 0)'
-        )
-
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
-
-        cursor.close()
-        self._connection.commit()
+        self._modify('add_user_privilege', user)
 
     def update_user_balance(self, user, ticket_uid, datetime, balance_diff, operation_type):
-        user_privilege = self.get_user_privilege(user)
-
-        assert user_privilege is not None
-        privilege_id = user_privilege['id']
-
         if operation_type == 'DEBIT_THE_ACCOUNT':
-            new_balance = user_privilege['balance'] - balance_diff
+            signed_balance_diff = -balance_diff
         else:
-            new_balance = user_privilege['balance'] + balance_diff
-
-        query = tools.simplify_sql_query(
-            f'START TRANSACTION;\n'
+            signed_balance_diff = balance_diff
 
-            f'UPDATE privilege SET balance = {new_balance} WHERE username = \'{user}\';\n'
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(
+                cursor, 'update_user_balance', user, signed_balance_diff, ticket_uid, datetime, balance_diff, operation_type
+            )
 
-            f'INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
-            f'VALUES({privilege_id}, \'{ticket_uid}\', \'{datetime}\', {balance_diff}, \'{operation_type}\');\n'
+            row = cursor.fetchone()
+            cursor.close()
+            connection.commit()
 
-            f'COMMIT TRANSACTION;'
-        )
+        if row is None:
+            return None
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+        if not row[2]:
+            raise errors.UserError({'message': 'not enough bonuses'}, 409)
 
-        cursor.close()
-        self._connection.commit()
+        return {
+            'status': row[0],
+            'balance': row[1]
+        }
     
     def get_privilege_history(self, privilege_id):
-        query = tools.simplify_sql_query(
-            f'SELECT id, privilege_id, ticket_uid, datetime, balance_diff, operation_type FROM privilege_history '
-            f'WHERE privilege_id = {privilege_id}'
-        )
+        return [BonusDbConnector._make_history(row) for row in self._fetch_all('get_privilege_history', privilege_id)]
+    
+    def get_privilege_history_by_ticket(self, ticket_uid):
+        return [
+            BonusDbConnector._make_history(row) for row in self._fetch_all('get_privilege_history_by_ticket', ticket_uid)
+        ]
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+    def apply_balance_operations(self, user, operations):
+        with self._connection() as connection:
+            cursor = connection.cursor()
 
-        table = cursor.fetchall()
-        cursor.close()
+            self._execute(cursor, 'lock_user_privilege', user)
+            privilege_id, status, balance = cursor.fetchone()
 
-        if table is None:
-            return None
-        
-        return [
-            {
-                'id': row[0],
-                'privilege_id': row[1],
-                'ticket_uid': row[2],
-                'datetime': row[3],
-                'balance_diff': row[4],
-                'operation_type': row[5]
-            }
-            for row in table
-        ]
-    
-    def get_privilege_history_by_ticket(self, ticket_uid):
-        query = tools.simplify_sql_query(
-            f'SELECT id, privilege_id, ticket_uid, datetime, balance_diff, operation_type FROM privilege_history '
-            f'WHERE ticket_uid = \'{ticket_uid}\''
-        )
+            self._execute(
+                cursor,
+                'get_privilege_history_by_tickets',
+                privilege_id,
+                [uuid.UUID(operation['ticket_uid']) for operation in operations]
+            )
+            applied = set(str(row[0]) for row in cursor.fetchall())
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+            history = []
+            for operation in operations:
+                if operation['ticket_uid'] in applied:
+                    continue # already applied by a retried request
 
-        table = cursor.fetchall()
-        cursor.close()
+                if operation['operation_type'] == 'DEBIT_THE_ACCOUNT':
+                    if balance < operation['balance_diff']:
+                        raise errors.UserError({'message': 'not enough bonuses'}, 409)
+
+                    balance -= operation['balance_diff']
+                else:
+                    balance += operation['balance_diff']
+
+                history.append(
+                    (
+                        privilege_id,
+                        operation['ticket_uid'],
+                        operation['datetime'],
+                        operation['balance_diff'],
+                        operation['operation_type']
+                    )
+                )
+
+            self._execute_balance_update(cursor, privilege_id, balance, history)
+
+            cursor.close()
+            connection.commit()
+
+        return {
+            'status': status,
+            'balance': balance
+        }
+
+    def revert_balance_operations(self, user, ticket_uids, datetime):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+
+            self._execute(cursor, 'lock_user_privilege', user)
+            privilege_id, status, balance = cursor.fetchone()
+
+            ticket_uids = [str(uuid.UUID(ticket_uid)) for ticket_uid in ticket_uids]
+
+            self._execute(
+                cursor, 'get_privilege_history_by_tickets', privilege_id, [uuid.UUID(ticket_uid) for ticket_uid in ticket_uids]
+            )
+
+            operations = {}
+            for ticket_uid, balance_diff, operation_type in cursor.fetchall():
+                operations.setdefault(str(ticket_uid), []).append((balance_diff, operation_type))
+
+            history = []
+            for ticket_uid in ticket_uids:
+                if len(operations.get(ticket_uid, [])) != 1:
+                    continue # unknown or already reverted
+
+                balance_diff, operation_type = operations[ticket_uid][0]
+
+                if operation_type == 'FILL_IN_BALANCE':
+                    balance_diff = min(balance, balance_diff)
+                    balance -= balance_diff
+                    operation_type = 'DEBIT_THE_ACCOUNT'
+                else:
+                    balance += balance_diff
+                    operation_type = 'FILL_IN_BALANCE'
+
+                history.append((privilege_id, ticket_uid, datetime, balance_diff, operation_type))
+
+            self._execute_balance_update(cursor, privilege_id, balance, history)
+
+            cursor.close()
+            connection.commit()
+
+        return {
+            'status': status,
+            'balance': balance,
+            'reverted': len(history)
+        }
+
+    def _execute_balance_update(self, cursor, privilege_id, balance, history):
+        if len(history) == 0:
+            return
+
+        self._logger.debug(f'Update balance of privilege {privilege_id} to {balance} with {len(history)} operations')
+
+        self._execute(cursor, 'set_privilege_balance', balance, privilege_id)
+
+        execute_values(
+            cursor,
+            tools.simplify_sql_query(
+                'INSERT INTO privilege_history(privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+                'VALUES %s'
+            ),
+            history
+        )
 
-        if table is None:
-            return None
-        
-        return [
-            {
-                'id': row[0],
-                'privilege_id': row[1],
-                'ticket_uid': row[2],
-                'datetime': row[3],
-                'balance_diff': row[4],
-                'operation_type': row[5]
-            }
-            for row in table
-        ]
 
 class BonusService(ServerBaseWithAuth0):
+    MAX_BATCH_SIZE = 100
+
     def __init__(
             self, 
             host, 
             port, 
             db_connector,
-            authorize_service_api_key, authorize_service_secret_key, authorize_service_url
+            authorize_service_api_key, authorize_service_secret_key, authorize_service_url,
+            **kwargs
         ):
         super().__init__(
             authorize_service_api_key, 
@@ -153,7 +250,8 @@ class BonusService(ServerBaseWithAuth0):
             'BounsService', 
             host, 
             port, 
-            db_connector
+            db_connector,
+            **kwargs
         )
 
     # API requests handlers
@@ -200,12 +298,6 @@ class BonusService(ServerBaseWithAuth0):
         if method == 'POST':
             username = self._get_username(self._get_user_token(request))
 
-            user_privilege = self._db_connector.get_user_privilege(username)
-
-            if user_privilege is None:
-                self._db_connector.add_user_privilege(username)
-                user_privilege = self._db_connector.get_user_privilege(username)
-
             UserValue.get_from(request.headers, 'Content-Type').rule(rules.json_content)
             body = request.json
 
@@ -219,8 +311,15 @@ class BonusService(ServerBaseWithAuth0):
             else:
                 operation_type = 'DEBIT_THE_ACCOUNT'
 
-            self._db_connector.update_user_balance(username, ticket_uid, datetime, balance_diff, operation_type)
-            user_privilege = self._db_connector.get_user_privilege(username)
+            user_privilege = self._db_connector.update_user_balance(
+                username, ticket_uid, datetime, balance_diff, operation_type
+            )
+
+            if user_privilege is None:
+                self._db_connector.add_user_privilege(username)
+                user_privilege = self._db_connector.update_user_balance(
+                    username, ticket_uid, datetime, balance_diff, operation_type
+                )
 
             return make_response(
                 {
@@ -232,39 +331,105 @@ class BonusService(ServerBaseWithAuth0):
         if method == 'DELETE':
             username = self._get_username(self._get_user_token(request))
 
-            user_privilege = self._db_connector.get_user_privilege(username)
+            ticket_uid = str(UserValue('ticketUid', ticket_uid).cast_to(uuid.UUID).value)
 
-            if user_privilege is None:
+            if self._db_connector.get_user_privilege(username) is None:
                 raise errors.UserError({'message': 'non existed user'})
 
-            privilege_history = self._db_connector.get_privilege_history_by_ticket(ticket_uid)
+            self._db_connector.revert_balance_operations(
+                username, [ticket_uid], ServerBaseWithAuth0.get_current_datetime()
+            )
 
-            if len(privilege_history) == 2:
-                return make_response() # already deleted
+            return make_response()
+        
+        assert False, 'Invalid request method'
 
-            assert len(privilege_history) == 1
-            privilege_history = privilege_history[0]
+    @ServerBaseWithAuth0.route(path='/api/v1/privilege/batch', methods=['POST'])
+    def _api_v1_privilege_batch(self):
+        method = request.method
 
-            datetime = ServerBaseWithAuth0.get_current_datetime()
+        if method == 'POST':
+            username = self._get_username(self._get_user_token(request))
 
-            if privilege_history['operation_type'] == 'FILL_IN_BALANCE':
-                balance_diff = min(user_privilege['balance'], privilege_history['balance_diff'])
-                self._db_connector.update_user_balance(username, ticket_uid, datetime, balance_diff, 'DEBIT_THE_ACCOUNT')
-            else:
-                balance_diff = privilege_history['balance_diff']
-                self._db_connector.update_user_balance(username, ticket_uid, datetime, balance_diff, 'FILL_IN_BALANCE')
+            UserValue.get_from(request.headers, 'Content-Type').rule(rules.json_content)
+            items = self._get_batch_items(request.json, 'items')
 
+            operations = []
+            for item in items:
+                UserValue('items', item).rule(rules.json_object)
+
+                with UserValue.ErrorChain() as error_chain:
+                    ticket_uid = UserValue.get_from(item, 'ticketUid', error_chain).expected(str).cast_to(uuid.UUID).value
+                    paid_from_balance = UserValue.get_from(item, 'paidFromBalance', error_chain).expected(bool).value
+                    datetime = UserValue.get_from(item, 'datetime', error_chain).expected(str).value
+                    balance_diff = UserValue.get_from(item, 'balanceDiff', error_chain).expected(int).rule(rules.greate_equal_zero).value
+
+                operations.append(
+                    {
+                        'ticket_uid': str(ticket_uid),
+                        'datetime': datetime,
+                        'balance_diff': balance_diff,
+                        'operation_type': 'DEBIT_THE_ACCOUNT' if paid_from_balance else 'FILL_IN_BALANCE'
+                    }
+                )
+
+            self._ensure_user_privilege(username)
+
+            user_privilege = self._db_connector.apply_balance_operations(username, operations)
+
+            return make_response(user_privilege, 200)
+
+        assert False, 'Invalid request method'
+
+    @ServerBaseWithAuth0.route(path='/api/v1/privilege/batch/cancel', methods=['POST'])
+    def _api_v1_privilege_batch_cancel(self):
+        method = request.method
+
+        if method == 'POST':
+            username = self._get_username(self._get_user_token(request))
+
+            UserValue.get_from(request.headers, 'Content-Type').rule(rules.json_content)
+            ticket_uids = [
+                str(UserValue('ticketUids', ticket_uid).expected(str).cast_to(uuid.UUID).value)
+                for ticket_uid in self._get_batch_items(request.json, 'ticketUids')
+            ]
+
+            if self._db_connector.get_user_privilege(username) is None:
+                raise errors.UserError({'message': 'non existed user'})
+
+            user_privilege = self._db_connector.revert_balance_operations(
+                username, list(dict.fromkeys(ticket_uids)), ServerBaseWithAuth0.get_current_datetime()
+            )
+
+            return make_response(user_privilege, 200)
 
-            return make_response()
-        
         assert False, 'Invalid request method'
         
     # Helpers
     ####################################################################################################################
 
+    def _ensure_user_privilege(self, username):
+        if self._db_connector.get_user_privilege(username) is None:
+            self._db_connector.add_user_privilege(username)
+
+    @staticmethod
+    def _get_batch_items(body, name):
+        UserValue('body', body).rule(rules.json_object)
+
+        items = UserValue.get_from(body, name).expected(list).rule(rules.not_empty).value
+
+        if len(items) > BonusService.MAX_BATCH_SIZE:
+            raise errors.UserError({name: f'Too many values, max {BonusService.MAX_BATCH_SIZE}'}, 400)
+
+        return items
+
+    ####################################################################################################################
+
     def _register_routes(self):
         self._register_route('_api_v1_privilege')
         self._register_route('_api_v1_privilege_aUid')
+        self._register_route('_api_v1_privilege_batch')
+        self._register_route('_api_v1_privilege_batch_cancel')
 
 if __name__ == '__main__':
     tools.set_basic_logging_config()
@@ -278,6 +443,17 @@ if __name__ == '__main__':
     parser.add_argument('--db-user', type=str, required=True)
     parser.add_argument('--db-password', type=str, required=True)
     parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--db-pool-min-size', type=int, default=1)
+    parser.add_argument('--db-pool-max-size', type=int, default=10)
+    parser.add_argument('--db-pool-checkout-timeout', type=float, default=5)
+    parser.add_argument('--http-pool-size', type=int, default=10)
+    parser.add_argument('--http-connect-timeout', type=float, default=3)
+    parser.add_argument('--http-read-timeout', type=float, default=10)
+    parser.add_argument('--http-pool-timeout', type=float, default=5)
+    parser.add_argument('--token-cache-size', type=int, default=1024)
+    parser.add_argument('--identity-secret', type=str, default=None)
+    parser.add_argument('--identity-ttl', type=int, default=60)
+    parser.add_argument('--trust-internal-identity', action='store_true')
     parser.add_argument('--debug', action='store_true')
 
     cmd_args = parser.parse_args()
@@ -296,11 +472,22 @@ if __name__ == '__main__':
             cmd_args.db,
             cmd_args.db_user,
             cmd_args.db_password,
-            cmd_args.db_sslmode
+            cmd_args.db_sslmode,
+            pool_min_size=cmd_args.db_pool_min_size,
+            pool_max_size=cmd_args.db_pool_max_size,
+            pool_checkout_timeout_s=cmd_args.db_pool_checkout_timeout
         ),
         'cRvxa4PfI6aJTiuOgJoY44qjsj9JFjxx',
         '4yejzOesJYPF-K9P-TIh93w5V4ki0quOIIRuc2MI9WgdUDNCGPj_r6YciYKwjVgg',
-        'dev-r6rulu3m7tph7f63.us.auth0.com'
+        'dev-r6rulu3m7tph7f63.us.auth0.com',
+        http_pool_size=cmd_args.http_pool_size,
+        http_connect_timeout_s=cmd_args.http_connect_timeout,
+        http_read_timeout_s=cmd_args.http_read_timeout,
+        http_pool_timeout_s=cmd_args.http_pool_timeout,
+        token_cache_size=cmd_args.token_cache_size,
+        identity_secret=cmd_args.identity_secret,
+        identity_ttl_s=cmd_args.identity_ttl,
+        trust_internal_identity=cmd_args.trust_internal_identity
     )
 
     service.run(cmd_args.debug)
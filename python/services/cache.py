@@ -0,0 +1,164 @@
+import asyncio
+import threading
+
+from collections import OrderedDict
+
+from time import time
+
+
+class TtlLruCache:
+    def __init__(self, max_size, ttl_s=None):
+        self._max_size = max_size
+        self._ttl_s = ttl_s
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+
+            if item is None:
+                self.misses += 1
+                return default
+
+            value, expire_time = item
+
+            if expire_time is not None and expire_time <= time():
+                del self._items[key]
+
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+
+            self.hits += 1
+            return value
+
+    def put(self, key, value, expire_time=None):
+        if expire_time is None and self._ttl_s is not None:
+            expire_time = time() + self._ttl_s
+
+        with self._lock:
+            self._items[key] = (value, expire_time)
+            self._items.move_to_end(key)
+
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+
+        return None if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def purge(self, predicate):
+        with self._lock:
+            keys = [key for key in self._items.keys() if predicate(key)]
+
+            for key in keys:
+                del self._items[key]
+
+        return len(keys)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+            'size': len(self._items),
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class SingleFlight:
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.suppressed = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+
+            if is_leader:
+                call = SingleFlight._Call()
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.suppressed += 1
+
+        if not is_leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func()
+
+        except BaseException as error:
+            call.error = error
+            raise
+
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+        return call.result
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'calls': self.calls,
+            'suppressed': self.suppressed,
+            'suppression_rate': self.suppressed / (self.calls + self.suppressed) if self.calls != 0 else 0
+        }
+
+
+class AsyncSingleFlight(SingleFlight):
+    async def do(self, key, func):
+        task = self._calls.get(key)
+
+        if task is not None:
+            self.suppressed += 1
+        else:
+            task = asyncio.ensure_future(func())
+            task.add_done_callback(lambda task: self._finish(key, task))
+
+            self._calls[key] = task
+            self.calls += 1
+
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+        if not task.cancelled():
+            task.exception()
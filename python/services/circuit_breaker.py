@@ -0,0 +1,151 @@
+import logging
+import threading
+
+from collections import deque
+
+from time import monotonic
+
+
+class CircuitBreaker:
+    CLOSED = 'CLOSED'
+    OPEN = 'OPEN'
+    HALF_OPEN = 'HALF_OPEN'
+
+    def __init__(self, name, min_requests=10, failure_rate=0.5, window_s=30, open_s=10, half_open_probes=1):
+        self._logger = logging.getLogger(f'CircuitBreaker {name}')
+
+        self._min_requests = min_requests
+        self._failure_rate = failure_rate
+        self._window_s = window_s
+        self._open_s = open_s
+        self._half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self._results = deque()
+        self._failures = 0
+
+        self.state = CircuitBreaker.CLOSED
+        self._opened_time = 0
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+
+    def is_available(self):
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+
+            if self.state == CircuitBreaker.OPEN:
+                return monotonic() - self._opened_time >= self._open_s
+
+            return self._half_open_in_flight < self._half_open_probes
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+
+            if self.state == CircuitBreaker.OPEN:
+                if monotonic() - self._opened_time < self._open_s:
+                    return False
+
+                self._to_half_open()
+
+            if self._half_open_in_flight >= self._half_open_probes:
+                return False
+
+            self._half_open_in_flight += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+                self._half_open_successes += 1
+
+                if self._half_open_successes >= self._half_open_probes:
+                    self._to_closed()
+
+                return
+
+            if self.state == CircuitBreaker.CLOSED:
+                self._add_result(False)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+                self._to_open()
+
+                return
+
+            if self.state == CircuitBreaker.CLOSED:
+                self._add_result(True)
+                self._check_failure_rate()
+
+    def record_cancel(self):
+        with self._lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+
+    def record_health(self, healthy):
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                self._add_result(not healthy)
+
+                if not healthy:
+                    self._check_failure_rate()
+
+            elif not healthy:
+                if self.state == CircuitBreaker.OPEN:
+                    self._opened_time = monotonic()
+                else:
+                    self._to_open()
+
+    def stats(self):
+        with self._lock:
+            self._trim_window()
+
+            return {
+                'state': self.state,
+                'requests': len(self._results),
+                'failures': self._failures,
+                'failure_rate': self._failures / len(self._results) if len(self._results) != 0 else 0
+            }
+
+    def _check_failure_rate(self):
+        if len(self._results) >= self._min_requests:
+            if self._failures / len(self._results) >= self._failure_rate:
+                self._to_open()
+
+    def _add_result(self, failed):
+        self._results.append((monotonic(), failed))
+        self._failures += failed
+
+        self._trim_window()
+
+    def _trim_window(self):
+        window_start = monotonic() - self._window_s
+
+        while len(self._results) != 0 and self._results[0][0] < window_start:
+            _, failed = self._results.popleft()
+            self._failures -= failed
+
+    def _to_open(self):
+        self._logger.warning(f'Circuit {self.state} -> {CircuitBreaker.OPEN}')
+
+        self.state = CircuitBreaker.OPEN
+        self._opened_time = monotonic()
+
+    def _to_half_open(self):
+        self._logger.info(f'Circuit {self.state} -> {CircuitBreaker.HALF_OPEN}')
+
+        self.state = CircuitBreaker.HALF_OPEN
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+
+    def _to_closed(self):
+        self._logger.info(f'Circuit {self.state} -> {CircuitBreaker.CLOSED}')
+
+        self.state = CircuitBreaker.CLOSED
+        self._results.clear()
+        self._failures = 0
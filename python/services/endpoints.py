@@ -0,0 +1,143 @@
+import logging
+import random
+import socket
+import threading
+
+
+class Endpoint:
+    def __init__(self, url, breaker):
+        self.url = url
+        self.breaker = breaker
+        self.outstanding = 0
+        self.healthy = True
+        self.last_health_check_time = 0
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'last_health_check_time': self.last_health_check_time,
+            'outstanding': self.outstanding,
+            'circuit': self.breaker.stats()
+        }
+
+
+class EndpointSource:
+    def __init__(self, hosts, port, file_path=None, resolve_dns=False):
+        self._hosts = hosts
+        self._port = port
+        self._file_path = file_path
+        self._resolve_dns = resolve_dns
+
+    def is_dynamic(self):
+        return self._file_path is not None or self._resolve_dns
+
+    def resolve(self):
+        addresses = [(host, self._port) for host in self._hosts]
+
+        if self._file_path is not None:
+            addresses = self._read_file()
+
+        if self._resolve_dns:
+            addresses = [
+                resolved_address
+                for host, port in addresses
+                for resolved_address in self._resolve_host(host, port)
+            ]
+
+        return list(dict.fromkeys(f'http://{host}:{port}' for host, port in addresses))
+
+    def _read_file(self):
+        addresses = []
+
+        with open(self._file_path) as file:
+            for line in file:
+                line = line.split('#')[0].strip()
+
+                if len(line) == 0:
+                    continue
+
+                host, _, port = line.rpartition(':')
+                if len(host) == 0:
+                    host, port = port, self._port
+
+                addresses.append((host, int(port)))
+
+        return addresses
+
+    @staticmethod
+    def _resolve_host(host, port):
+        return [
+            (address[4][0], port)
+            for address in socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+        ]
+
+
+class ServiceInfo:
+    def __init__(self, name, source, make_breaker):
+        self._logger = logging.getLogger(f'ServiceInfo {name}')
+
+        self.name = name
+        self.source = source
+        self._make_breaker = make_breaker
+
+        self._lock = threading.Lock()
+        self.endpoints = []
+
+        self.refresh_endpoints()
+
+    @property
+    def healthy(self):
+        return any(endpoint.healthy for endpoint in self.endpoints)
+
+    def refresh_endpoints(self):
+        try:
+            urls = self.source.resolve()
+
+        except Exception as exception:
+            self._logger.error(f'Failed to resolve endpoints, keep {len(self.endpoints)} known, error: {exception}')
+
+            return
+
+        if len(urls) == 0:
+            self._logger.error(f'Resolved empty endpoint list, keep {len(self.endpoints)} known')
+
+            return
+
+        with self._lock:
+            known_endpoints = {endpoint.url: endpoint for endpoint in self.endpoints}
+
+            if list(known_endpoints.keys()) == urls:
+                return
+
+            self.endpoints = [
+                known_endpoints[url] if url in known_endpoints else Endpoint(url, self._make_breaker(url))
+                for url in urls
+            ]
+
+        self._logger.info(f'Endpoints: {urls}')
+
+    def acquire_endpoint(self):
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.breaker.is_available()]
+
+            if len(candidates) >= 2:
+                candidates = random.sample(candidates, 2)
+
+            for endpoint in sorted(candidates, key=lambda endpoint: endpoint.outstanding):
+                if endpoint.breaker.allow_request():
+                    endpoint.outstanding += 1
+
+                    return endpoint
+
+        return None
+
+    def release_endpoint(self, endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    def stats(self):
+        return {
+            'healthy': self.healthy,
+            'endpoints': [endpoint.stats() for endpoint in self.endpoints]
+        }
@@ -3,6 +3,9 @@ import logging
 from base import ServiceBase
 from base import DbConnectorBase
 
+from cache import TtlLruCache
+from cache import SingleFlight
+
 import tools
 import errors
 import rules
@@ -12,90 +15,333 @@ from flask import request
 from flask import make_response
 
 import argparse
+import bisect
+import select
+import threading
+
+from time import sleep
+from time import time
 
 
 class FlightDbConnector(DbConnectorBase):
-    def __init__(self, host, port, database, user, password, sslmode='disable'):
-        super().__init__('FlightDbConnector', host, port, database, user, password, sslmode)
-
-    def get_flights(self, page_number, page_size):
-        query = tools.simplify_sql_query(
-            f'SELECT id, number, datetime, price, from_airport, to_airport FROM('
-            f'    SELECT '
-            f'        flight.id, '
-            f'        number, '
-            f'        datetime, '
-            f'        price, '
-            f'        CONCAT(from_airport.city, \' \' , from_airport.name) as from_airport, '
-            f'        CONCAT(to_airport.city, \' \', to_airport.name) as to_airport, '
-            f'        ROW_NUMBER() OVER (ORDER BY flight.id) as row '
-            f'    FROM flight '
-            f'    JOIN airport as from_airport ON flight.from_airport_id = from_airport.id '
-            f'    JOIN airport as to_airport ON flight.to_airport_id = to_airport.id'
-            f') as flight_with_row '
-            f'WHERE {(page_number - 1) * page_size + 1} <= row AND row < {page_number * page_size + 1}'
-        )
+    FLIGHT_QUERY = (
+        'SELECT '
+        '    flight.id, '
+        '    number, '
+        '    datetime, '
+        '    price, '
+        '    CONCAT(from_airport.city, \' \' , from_airport.name) as from_airport, '
+        '    CONCAT(to_airport.city, \' \', to_airport.name) as to_airport '
+        'FROM flight '
+        'JOIN airport as from_airport ON flight.from_airport_id = from_airport.id '
+        'JOIN airport as to_airport ON flight.to_airport_id = to_airport.id '
+    )
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
-
-        table = cursor.fetchall()
-        cursor.close()
-
-        return [
-            {
-                'id': row[0],
-                'number': row[1],
-                'datetime': row[2],
-                'price': row[3],
-                'from_airport': row[4],
-                'to_airport': row[5]
-            }
-            for row in table
-        ]
+    STATEMENTS = {
+        'get_flights': FLIGHT_QUERY + 'ORDER BY flight.id LIMIT $1 OFFSET $2',
+        'get_flights_after': FLIGHT_QUERY + 'WHERE flight.id > $1 ORDER BY flight.id LIMIT $2',
+        'get_flights_count': 'SELECT COUNT(*) FROM flight',
+        'get_all_flights': FLIGHT_QUERY + 'ORDER BY flight.id',
+        'get_flights_by_ids': FLIGHT_QUERY + 'WHERE flight.id = ANY($1)',
+        'get_flights_by_airports': FLIGHT_QUERY + 'WHERE from_airport_id = ANY($1) OR to_airport_id = ANY($1)',
+        'get_flight_by_number': FLIGHT_QUERY + 'WHERE number = $1',
+        'get_flights_by_numbers': FLIGHT_QUERY + 'WHERE number = ANY($1)'
+    }
+
+    def __init__(self, host, port, database, user, password, sslmode='disable', **kwargs):
+        super().__init__('FlightDbConnector', host, port, database, user, password, sslmode, **kwargs)
+
+    @staticmethod
+    def _make_flight(row):
+        return {
+            'id': row[0],
+            'number': row[1],
+            'datetime': row[2],
+            'price': row[3],
+            'from_airport': row[4],
+            'to_airport': row[5]
+        }
 
-    def get_flight_by_number(self, number):
-        query = tools.simplify_sql_query(
-            f'SELECT id, number, datetime, price, from_airport, to_airport FROM('
-            f'    SELECT '
-            f'        flight.id, '
-            f'        number, '
-            f'        datetime, '
-            f'        price, '
-            f'        CONCAT(from_airport.city, \' \' , from_airport.name) as from_airport, '
-            f'        CONCAT(to_airport.city, \' \', to_airport.name) as to_airport '
-            f'    FROM flight '
-            f'    JOIN airport as from_airport ON flight.from_airport_id = from_airport.id '
-            f'    JOIN airport as to_airport ON flight.to_airport_id = to_airport.id'
-            f') as flight_with_airport '
-            f'WHERE number = \'{number}\''
-        )
+    def get_flights(self, offset, limit):
+        table = self._fetch_all('get_flights', limit, offset)
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+        return [FlightDbConnector._make_flight(row) for row in table]
 
-        row = cursor.fetchone()
-        cursor.close()
+    def get_flights_after(self, cursor, limit):
+        table = self._fetch_all('get_flights_after', cursor, limit)
+
+        return [FlightDbConnector._make_flight(row) for row in table]
+
+    def get_flights_count(self):
+        return self._fetch_one('get_flights_count')[0]
+
+    def get_flight_by_number(self, number):
+        row = self._fetch_one('get_flight_by_number', number)
 
         if row is None:
             return None
 
+        return FlightDbConnector._make_flight(row)
+
+    def get_flights_by_numbers(self, numbers):
+        table = self._fetch_all('get_flights_by_numbers', list(numbers))
+
+        return [FlightDbConnector._make_flight(row) for row in table]
+
+    def get_all_flights(self):
+        table = self._fetch_all('get_all_flights')
+
+        return [FlightDbConnector._make_flight(row) for row in table]
+
+    def get_flights_by_ids(self, ids):
+        table = self._fetch_all('get_flights_by_ids', list(ids))
+
+        return [FlightDbConnector._make_flight(row) for row in table]
+
+    def get_flights_by_airports(self, airport_ids):
+        table = self._fetch_all('get_flights_by_airports', list(airport_ids))
+
+        return [FlightDbConnector._make_flight(row) for row in table]
+
+
+class FlightCatalog:
+    CHANNEL = 'flight_catalog'
+    MAX_INCREMENTAL_CHANGES = 100
+    KEEPALIVE_IDLE_S = 10
+    KEEPALIVE_INTERVAL_S = 5
+    KEEPALIVE_COUNT = 3
+
+    def __init__(self, db_connector, poll_timeout_s=5, reconnect_delay_s=5):
+        self._logger = logging.getLogger('FlightCatalog')
+
+        self._db_connector = db_connector
+        self._poll_timeout_s = poll_timeout_s
+        self._reconnect_delay_s = reconnect_delay_s
+
+        self._flights_by_id = {}
+        self._ids = []
+        self._ids_by_number = {}
+        self._lock = threading.Lock()
+
+        self._ready = False
+        self._listen_connection = None
+        self._listener_thread = None
+
+        self.loaded_at = None
+        self.full_reloads = 0
+        self.incremental_updates = 0
+        self.notifications = 0
+        self.listener_failures = 0
+
+    def start(self):
+        if self._listener_thread is not None:
+            return
+
+        try:
+            self._listen()
+
+        except Exception as exception:
+            self._close_listen_connection()
+            error = str(exception).replace('\n', ' ').strip()
+            self._logger.warning(f'Failed to load flight catalog, serving flights from database, error: {error}')
+
+        self._listener_thread = threading.Thread(target=self._run_listener, name='FlightCatalogListener', daemon=True)
+        self._listener_thread.start()
+
+    def is_ready(self):
+        return self._ready
+
+    def reload(self):
+        flights = self._db_connector.get_all_flights()
+
+        flights_by_id = {flight['id']: flight for flight in flights}
+        ids = sorted(flights_by_id)
+        ids_by_number = {flight['number']: flight['id'] for flight in flights}
+
+        with self._lock:
+            self._flights_by_id = flights_by_id
+            self._ids = ids
+            self._ids_by_number = ids_by_number
+
+        self._ready = True
+        self.loaded_at = time()
+        self.full_reloads += 1
+
+        self._logger.info(f'Loaded {len(ids)} flights')
+
+    def get_flight_by_number(self, number):
+        with self._lock:
+            flight_id = self._ids_by_number.get(number)
+
+            return None if flight_id is None else self._flights_by_id[flight_id]
+
+    def get_flights_by_numbers(self, numbers):
+        with self._lock:
+            return [
+                self._flights_by_id[self._ids_by_number[number]] for number in numbers if number in self._ids_by_number
+            ]
+
+    def get_flights(self, offset, limit):
+        with self._lock:
+            return [self._flights_by_id[flight_id] for flight_id in self._ids[offset:offset + limit]]
+
+    def get_flights_after(self, cursor, limit):
+        with self._lock:
+            begin = bisect.bisect_right(self._ids, cursor)
+
+            return [self._flights_by_id[flight_id] for flight_id in self._ids[begin:begin + limit]]
+
+    def get_flights_count(self):
+        return len(self._ids)
+
+    def stats(self):
         return {
-            'id': row[0],
-            'number': row[1],
-            'datetime': row[2],
-            'price': row[3],
-            'from_airport': row[4],
-            'to_airport': row[5]
+            'ready': self._ready,
+            'size': len(self._ids),
+            'loaded_at': self.loaded_at,
+            'full_reloads': self.full_reloads,
+            'incremental_updates': self.incremental_updates,
+            'notifications': self.notifications,
+            'listener_failures': self.listener_failures
         }
 
+    def _listen(self):
+        connection = self._db_connector.connect(
+            keepalives=1,
+            keepalives_idle=FlightCatalog.KEEPALIVE_IDLE_S,
+            keepalives_interval=FlightCatalog.KEEPALIVE_INTERVAL_S,
+            keepalives_count=FlightCatalog.KEEPALIVE_COUNT
+        )
+        connection.autocommit = True
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {FlightCatalog.CHANNEL}')
+
+        self._listen_connection = connection
+
+        self.reload()
+
+    def _close_listen_connection(self):
+        self._ready = False
+
+        if self._listen_connection is not None:
+            try:
+                self._listen_connection.close()
+
+            except Exception:
+                pass
+
+            self._listen_connection = None
+
+    def _run_listener(self):
+        while True:
+            try:
+                if self._listen_connection is None:
+                    self._listen()
+
+                self._poll()
+
+            except (Exception, errors.ServerError) as exception:
+                self.listener_failures += 1
+                error = str(exception.message if isinstance(exception, errors.ServerError) else exception)
+                error = error.replace('\n', ' ').strip()
+                self._logger.error(f'Flight catalog listener failed, serving flights from database, error: {error}')
+
+                self._close_listen_connection()
+                sleep(self._reconnect_delay_s)
+
+    def _poll(self):
+        connection = self._listen_connection
+
+        if select.select([connection], [], [], self._poll_timeout_s) == ([], [], []):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        else:
+            connection.poll()
+
+        flight_ids = set()
+        airport_ids = set()
+        full_reload = False
+
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            self.notifications += 1
+
+            table, _, key = notify.payload.partition(':')
+
+            if key == '*':
+                full_reload = True
+            elif table == 'flight':
+                flight_ids.add(int(key))
+            elif table == 'airport':
+                airport_ids.add(int(key))
+
+        if full_reload or len(flight_ids) + len(airport_ids) > FlightCatalog.MAX_INCREMENTAL_CHANGES:
+            self.reload()
+        elif len(flight_ids) != 0 or len(airport_ids) != 0:
+            self._apply_changes(flight_ids, airport_ids)
+
+    def _apply_changes(self, flight_ids, airport_ids):
+        flights = []
+
+        if len(flight_ids) != 0:
+            flights += self._db_connector.get_flights_by_ids(flight_ids)
+        if len(airport_ids) != 0:
+            flights += self._db_connector.get_flights_by_airports(airport_ids)
+
+        with self._lock:
+            for flight_id in flight_ids:
+                self._remove(flight_id)
+
+            for flight in flights:
+                self._put(flight)
+
+        self.incremental_updates += 1
+
+        self._logger.debug(f'Updated flight catalog, flights: {sorted(flight_ids)}, airports: {sorted(airport_ids)}')
+
+    def _put(self, flight):
+        old_flight = self._flights_by_id.get(flight['id'])
+
+        if old_flight is None:
+            bisect.insort(self._ids, flight['id'])
+        elif self._ids_by_number.get(old_flight['number']) == flight['id']:
+            del self._ids_by_number[old_flight['number']]
+
+        self._flights_by_id[flight['id']] = flight
+        self._ids_by_number[flight['number']] = flight['id']
+
+    def _remove(self, flight_id):
+        flight = self._flights_by_id.pop(flight_id, None)
+
+        if flight is None:
+            return
+
+        del self._ids[bisect.bisect_left(self._ids, flight_id)]
+
+        if self._ids_by_number.get(flight['number']) == flight_id:
+            del self._ids_by_number[flight['number']]
+
 
 class FlightService(ServiceBase):
-    def __init__(self, host, port, db_connector):
+    MAX_BATCH_SIZE = 500
+    DEFAULT_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+
+    def __init__(self, host, port, db_connector, flights_count_ttl_s=60, flight_catalog=False):
         super().__init__('FlightService', host, port, db_connector)
 
+        self._flights_count_cache = TtlLruCache(1, flights_count_ttl_s)
+        self._flights_count_single_flight = SingleFlight()
+
+        self._flight_catalog = FlightCatalog(db_connector) if flight_catalog else None
+
+    def run(self, debug=False):
+        if self._flight_catalog is not None:
+            self._flight_catalog.start()
+
+        super().run(debug)
+
     # API requests handlers
     ####################################################################################################################
 
@@ -105,30 +351,38 @@ class FlightService(ServiceBase):
 
         if method == 'GET':
 
-            with UserValue.ErrorChain() as error_chain:
-                page_number = UserValue.get_from(request.args, 'page', error_chain).cast_to_int().rule(rules.grater_zero).value
-                page_size = UserValue.get_from(request.args, 'size', error_chain).cast_to_int().rule(rules.grater_zero).value
+            page = self._get_page_args(request.args)
+
+            if page['number'] is None:
+                table = self._get_flights_source().get_flights_after(page['cursor'], page['size'] + 1)
+            else:
+                table = self._get_flights_source().get_flights((page['number'] - 1) * page['size'], page['size'] + 1)
+
+            next_cursor = None
+            if len(table) > page['size']:
+                table = table[:page['size']]
+                next_cursor = table[-1]['id']
+
+            message = {
+                'pageSize': page['size'],
+                'totalElements': self._get_flights_count(),
+                'items': [
+                    {
+                        'flightNumber': row['number'],
+                        'fromAirport': row['from_airport'],
+                        'toAirport': row['to_airport'],
+                        'date': row['datetime'],
+                        'price': row['price']
+                    }
+                    for row in table
+                ],
+                'nextCursor': next_cursor
+            }
 
-            table = self._db_connector.get_flights(page_number, page_size)
+            if page['number'] is not None:
+                message['page'] = page['number']
 
-            return make_response(
-                {
-                    'page': page_number,
-                    'pageSize': page_size,
-                    'totalElements': len(table),
-                    'items': [
-                        {
-                            'flightNumber': row['number'],
-                            'fromAirport': row['from_airport'],
-                            'toAirport': row['to_airport'],
-                            'date': row['datetime'],
-                            'price': row['price']
-                        }
-                        for row in table
-                    ]
-                },
-                200
-            )
+            return make_response(message, 200)
 
         assert False, 'Invalid request method'
 
@@ -137,7 +391,7 @@ class FlightService(ServiceBase):
         method = request.method
 
         if method == 'GET':
-            flight = self._db_connector.get_flight_by_number(number)
+            flight = self._get_flights_source().get_flight_by_number(number)
 
             if flight is None:
                 raise errors.UserError({'message': 'non existent flight'}, 404)
@@ -155,12 +409,94 @@ class FlightService(ServiceBase):
 
         assert False, 'Invalid request method'
 
+    @ServiceBase.route('/api/v1/flights/batch', ['GET'])
+    def _api_v1_flight_batch(self):
+        method = request.method
+
+        if method == 'GET':
+            numbers = UserValue.get_from(request.args, 'numbers').cast_to(tools.split_list).rule(rules.not_empty).value
+
+            if len(numbers) > FlightService.MAX_BATCH_SIZE:
+                raise errors.UserError({'numbers': f'Too many values, max {FlightService.MAX_BATCH_SIZE}'}, 400)
+
+            table = self._get_flights_source().get_flights_by_numbers(numbers)
+
+            return make_response(
+                {
+                    'items': [
+                        {
+                            'flightNumber': row['number'],
+                            'fromAirport': row['from_airport'],
+                            'toAirport': row['to_airport'],
+                            'date': row['datetime'],
+                            'price': row['price']
+                        }
+                        for row in table
+                    ]
+                },
+                200
+            )
+
+        assert False, 'Invalid request method'
+
     # Helpers
     ####################################################################################################################
 
+    @staticmethod
+    def _get_page_args(args):
+        page = {'number': None, 'size': FlightService.DEFAULT_PAGE_SIZE, 'cursor': 0}
+
+        with UserValue.ErrorChain() as error_chain:
+            if 'page' in args:
+                page['number'] = UserValue.get_from(args, 'page', error_chain).cast_to_int().rule(rules.grater_zero).value
+                page['size'] = UserValue.get_from(args, 'size', error_chain).cast_to_int().rule(rules.grater_zero).value
+            else:
+                if 'size' in args:
+                    page['size'] = UserValue.get_from(args, 'size', error_chain).cast_to_int().rule(rules.grater_zero).value
+                if 'cursor' in args:
+                    page['cursor'] = UserValue.get_from(args, 'cursor', error_chain).cast_to_int().rule(rules.grater_zero).value
+
+        if page['number'] is None:
+            page['size'] = min(page['size'], FlightService.MAX_PAGE_SIZE)
+
+        return page
+
+    def _get_flights_source(self):
+        if self._flight_catalog is not None and self._flight_catalog.is_ready():
+            return self._flight_catalog
+
+        return self._db_connector
+
+    def _get_flights_count(self):
+        if self._flight_catalog is not None and self._flight_catalog.is_ready():
+            return self._flight_catalog.get_flights_count()
+
+        count = self._flights_count_cache.get('count')
+
+        if count is None:
+            count = self._flights_count_single_flight.do('count', self._load_flights_count)
+
+        return count
+
+    def _load_flights_count(self):
+        count = self._db_connector.get_flights_count()
+        self._flights_count_cache.put('count', count)
+
+        return count
+
+    def _get_metrics(self):
+        metrics = super()._get_metrics()
+        metrics['flights_count_cache'] = self._flights_count_cache.stats()
+
+        if self._flight_catalog is not None:
+            metrics['flight_catalog'] = self._flight_catalog.stats()
+
+        return metrics
+
     def _register_routes(self):
         self._register_route('_api_v1_flight')
         self._register_route('_api_v1_flight_aNumber')
+        self._register_route('_api_v1_flight_batch')
 
 
 if __name__ == '__main__':
@@ -175,6 +511,11 @@ if __name__ == '__main__':
     parser.add_argument('--db-user', type=str, required=True)
     parser.add_argument('--db-password', type=str, required=True)
     parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--db-pool-min-size', type=int, default=1)
+    parser.add_argument('--db-pool-max-size', type=int, default=10)
+    parser.add_argument('--db-pool-checkout-timeout', type=float, default=5)
+    parser.add_argument('--flights-count-ttl', type=float, default=60)
+    parser.add_argument('--flight-catalog', action='store_true')
     parser.add_argument('--debug', action='store_true')
 
     cmd_args = parser.parse_args()
@@ -193,8 +534,13 @@ if __name__ == '__main__':
             cmd_args.db,
             cmd_args.db_user,
             cmd_args.db_password,
-            cmd_args.db_sslmode
-        )
+            cmd_args.db_sslmode,
+            pool_min_size=cmd_args.db_pool_min_size,
+            pool_max_size=cmd_args.db_pool_max_size,
+            pool_checkout_timeout_s=cmd_args.db_pool_checkout_timeout
+        ),
+        flights_count_ttl_s=cmd_args.flights_count_ttl,
+        flight_catalog=cmd_args.flight_catalog
     )
 
     service.run(cmd_args.debug)
@@ -1,29 +1,55 @@
 import logging
 
 from base import ServerBaseWithAuth0
-
-import requests
+from base import InternalIdentitySigner
+from circuit_breaker import CircuitBreaker
+from endpoints import ServiceInfo, EndpointSource
+from replay_queue import ReplayQueue
+from cache import TtlLruCache, SingleFlight
 
 from flask import request as flask_request
 from flask import make_response
+from flask import Response
 
 import tools
 
 import argparse
 
-from time import time
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
 from getters import UserValue
 import rules
 
-class ServiceInfo:
-    def __init__(self, url):
-        self.url = url
-        self.queue = []
-        self.error_level = 0
-        self.last_error_time = 0
+class RequestBackup:
+    def __init__(self, path, method, headers, args, data):
+        self.path = path
+        self.method = method
+        self.headers = headers
+        self.args = args
+        self.data = data
+
+class CachedResponse:
+    def __init__(self, status_code, headers, body, fresh_until):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.fresh_until = fresh_until
+
+class RequestBodyStream:
+    def __init__(self, stream, length):
+        self._stream = stream
+        self.len = length
+
+    def read(self, size=-1):
+        return self._stream.read(size)
 
 ALL_METHODS = ['GET', 'POST', 'DELETE']
+UNAVAILABLE_CODES = [502, 503, 504]
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class Gateway(ServerBaseWithAuth0):
@@ -34,7 +60,23 @@ class Gateway(ServerBaseWithAuth0):
         ticket_service_host, ticket_service_port,
         bonus_service_host, bonus_service_port,
         valid_error_level, wait_before_retry,
-        authorize_service_api_key, authorize_service_secret_key, authorize_service_url
+        authorize_service_api_key, authorize_service_secret_key, authorize_service_url,
+        breaker_failure_rate=0.5,
+        breaker_window_s=30,
+        breaker_half_open_probes=1,
+        health_check_interval_s=5,
+        replay_queue_path='replay_queue.db',
+        replay_workers=4,
+        replay_max_backoff_s=60,
+        flight_cache_size=1024,
+        flight_cache_ttl_s=30,
+        flight_cache_stale_s=60,
+        flight_service_endpoints_file=None,
+        ticket_service_endpoints_file=None,
+        bonus_service_endpoints_file=None,
+        resolve_dns=False,
+        endpoints_refresh_interval_s=30,
+        **kwargs
     ):
         super().__init__(
             authorize_service_api_key, 
@@ -42,28 +84,80 @@ class Gateway(ServerBaseWithAuth0):
             authorize_service_url, 
             'Gateway', 
             host,
-            port
+            port,
+            **kwargs
+        )
+
+        def make_breaker(url):
+            return CircuitBreaker(
+                url,
+                min_requests=valid_error_level,
+                failure_rate=breaker_failure_rate,
+                window_s=breaker_window_s,
+                open_s=wait_before_retry,
+                half_open_probes=breaker_half_open_probes
+            )
+
+        def make_service_info(name, hosts, port, endpoints_file):
+            return ServiceInfo(
+                name,
+                EndpointSource(hosts.split(','), port, endpoints_file, resolve_dns),
+                make_breaker
+            )
+
+        self._flight_service_info = make_service_info(
+            'flight', flight_service_host, flight_service_port, flight_service_endpoints_file
+        )
+        self._ticket_service_info = make_service_info(
+            'ticket', ticket_service_host, ticket_service_port, ticket_service_endpoints_file
         )
+        self._bonus_service_info = make_service_info(
+            'bonus', bonus_service_host, bonus_service_port, bonus_service_endpoints_file
+        )
+
+        self._health_check_interval_s = health_check_interval_s
+        self._health_prober_thread = None
+
+        self._endpoints_refresh_interval_s = endpoints_refresh_interval_s
+        self._endpoints_refresher_thread = None
+
+        self._replay_queue = ReplayQueue(
+            replay_queue_path, self._replay_request, replay_workers, max_backoff_s=replay_max_backoff_s
+        )
+
+        self._response_cache = None
+        if flight_cache_size > 0:
+            self._response_cache = TtlLruCache(flight_cache_size)
+
+        self._response_cache_ttl_s = flight_cache_ttl_s
+        self._response_cache_stale_s = flight_cache_stale_s
+        self._response_cache_stale_hits = 0
+        self._response_cache_revalidations = 0
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+        self._revalidate_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='Revalidate')
+
+        self._single_flight = SingleFlight()
 
-        self._flight_service_info = ServiceInfo(f'http://{flight_service_host}:{flight_service_port}')
-        self._ticket_service_info = ServiceInfo(f'http://{ticket_service_host}:{ticket_service_port}')
-        self._bonus_service_info = ServiceInfo(f'http://{bonus_service_host}:{bonus_service_port}')
+    def run(self, debug=False):
+        self._start_health_prober()
+        self._start_endpoints_refresher()
+        self._replay_queue.start()
 
-        self._valid_error_level = valid_error_level
-        self._wait_before_retry = wait_before_retry
+        super().run(debug)
 
     ################################################################################################
 
     @ServerBaseWithAuth0.route(path='/api/v1/flights', methods=ALL_METHODS)
     def _flight(self):
         return self._resend(
-            self._flight_service_info, f'/api/v1/flights', flask_request
+            self._flight_service_info, f'/api/v1/flights', flask_request, cacheable=True
         )
 
     @ServerBaseWithAuth0.route(path='/api/v1/flights/<path:path>', methods=ALL_METHODS)
     def _flight_aPath(self, path):
         return self._resend(
-            self._flight_service_info, f'/api/v1/flights/{path}', flask_request
+            self._flight_service_info, f'/api/v1/flights/{path}', flask_request, cacheable=True
         )
     
     ################################################################################################
@@ -110,7 +204,7 @@ class Gateway(ServerBaseWithAuth0):
         username = UserValue.get_from(request.json, 'username').expected(str).value
         password = UserValue.get_from(request.json, 'password').expected(str).value
 
-        response = requests.request(
+        response = self._http_client.request(
             'POST',
             f'{self._authorize_service_info.url}/oauth/token',
             headers={'Content-Type': 'application/x-www-form-urlencoded'},
@@ -135,90 +229,366 @@ class Gateway(ServerBaseWithAuth0):
     def _callback(self):
         return make_response('', 200)
 
-    ################################################################################################
+    @ServerBaseWithAuth0.route(path='/manage/cache', methods=['DELETE'])
+    def _manage_cache(self):
+        self._check_admin_token(flask_request.headers)
 
-    def _resend(self, service_info, path, request):
-        self._get_user_token(request)
+        prefix = flask_request.args.get('prefix', '')
 
-        try:
-            if len(service_info.queue) != 0:
-                if not self._check_service_health(service_info):
-                    raise RuntimeError('Service is unavailable')
+        purged = 0
+        if self._response_cache is not None:
+            purged = self._response_cache.purge(lambda key: key.startswith(prefix))
+
+        self._logger.info(f'Purged {purged} cached responses with prefix \'{prefix}\'')
 
-                for request_backup in service_info.queue:
-                    self._request(service_info, request_backup.path, request_backup)
-                    service_info.queue.remove(request_backup)
+        return make_response({'purged': purged}, 200)
+
+    ################################################################################################
 
-            return self._request(service_info, path, request)
+    def _resend(self, service_info, path, request, cacheable=False):
+        token = self._get_user_token(request)
+        headers = self._get_forward_headers(request.headers, token)
+
+        if cacheable and request.method == 'GET':
+            return self._resend_cacheable(service_info, path, request.args, headers)
+
+        try:
+            return self._request(
+                service_info, request.method, path, headers, request.args, self._get_request_body(request)
+            )
         
         except Exception:
             if request.method == 'DELETE':
-                class RequestBackup:
-                    def __init__(self, path, method, headers, args, data):
-                        self.path = path
-                        self.method = method
-                        self.headers = headers
-                        self.args = args
-                        self.data = data
-
-                service_info.queue.append(RequestBackup(path, request.method, request.headers, request.args, request.data))
-
-                return make_response('', 200)
+                if self._defer_request(
+                    service_info, token, RequestBackup(path, request.method, headers, request.args, request.get_data())
+                ):
+                    return make_response('', 200)
             
         return make_response('Internal server error', 500)
         
 
-    def _request(self, service_info, path, request):
-        method = request.method
+    def _resend_cacheable(self, service_info, path, args, headers):
+        key = self._get_cache_key(path, args)
+        headers = self._get_cacheable_headers(headers)
+
+        cached_response = None
+        if self._response_cache is not None:
+            cached_response = self._response_cache.get(key)
+
+        if cached_response is None:
+            try:
+                cached_response = self._single_flight.do(
+                    key, lambda: self._fetch_cacheable(key, service_info, path, args, headers)
+                )
+
+            except Exception:
+                return make_response('Internal server error', 500)
+
+        elif cached_response.fresh_until <= time.time():
+            self._response_cache_stale_hits += 1
+            self._revalidate(key, service_info, path, args, headers)
+
+        return Response(cached_response.body, status=cached_response.status_code, headers=cached_response.headers)
+
+    def _fetch_cacheable(self, key, service_info, path, args, headers):
+        response, release = self._send_stream(service_info, 'GET', path, headers, args, None)
 
         try:
-            self._logger.debug('Send request')
-            response = requests.request(
-                method,
-                f'{service_info.url}{path}',
-                headers=request.headers,
-                params=request.args,
-                data=request.data
+            body = response.raw.read(decode_content=False)
+        finally:
+            release()
+
+        return self._store_cached_response(
+            key, response.status_code, tools.strip_hop_by_hop_headers(response.headers), body
+        )
+
+    def _store_cached_response(self, key, status_code, headers, body):
+        now = time.time()
+        cached_response = CachedResponse(status_code, headers, body, now + self._response_cache_ttl_s)
+
+        if status_code == 200 and self._response_cache is not None:
+            self._response_cache.put(
+                key, cached_response, now + self._response_cache_ttl_s + self._response_cache_stale_s
+            )
+
+        return cached_response
+
+    def _revalidate(self, key, service_info, path, args, headers):
+        if not self._start_revalidation(key):
+            return
+
+        def revalidate():
+            try:
+                self._single_flight.do(key, lambda: self._fetch_cacheable(key, service_info, path, args, headers))
+
+            except Exception as exception:
+                self._logger.error(f'Failed to revalidate cached \'{key}\', error: {exception}')
+
+            finally:
+                self._finish_revalidation(key)
+
+        self._revalidate_executor.submit(revalidate)
+
+    def _start_revalidation(self, key):
+        with self._revalidating_lock:
+            if key in self._revalidating:
+                return False
+
+            self._revalidating.add(key)
+            self._response_cache_revalidations += 1
+
+            return True
+
+    def _finish_revalidation(self, key):
+        with self._revalidating_lock:
+            self._revalidating.discard(key)
+
+    @staticmethod
+    def _get_cache_key(path, args):
+        query = urlencode(sorted(args.items(multi=True) if hasattr(args, 'getlist') else args.items()))
+
+        return f'{path}?{query}'
+
+    @staticmethod
+    def _get_cacheable_headers(headers):
+        headers = {
+            name: value
+            for name, value in headers.items()
+            if name.lower() != 'accept-encoding'
+        }
+        headers['Accept-Encoding'] = 'identity'
+
+        return headers
+
+    def _get_forward_headers(self, headers, token):
+        auth_headers = self._get_auth_headers(token)
+        auth_header_names = [name.lower() for name in [*auth_headers.keys(), InternalIdentitySigner.HEADER]]
+
+        forward_headers = tools.strip_hop_by_hop_headers(headers, ['Host', *auth_header_names])
+        forward_headers.update(auth_headers)
+
+        return forward_headers
+
+    def _get_request_body(self, request):
+        if request.method == 'DELETE':
+            return request.get_data()
+
+        if request.content_length is not None:
+            return RequestBodyStream(request.stream, request.content_length)
+
+        if 'chunked' in request.headers.get('Transfer-Encoding', '').lower():
+            return iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b'')
+
+        return None
+
+    def _make_stream_response(self, response, release):
+        def generate():
+            try:
+                for chunk in response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False):
+                    yield chunk
+
+            except Exception as exception:
+                self._logger.error(f'Failed to stream response, error: {exception}')
+
+            finally:
+                release()
+
+        stream_response = Response(
+            generate(),
+            status=response.status_code,
+            headers=tools.strip_hop_by_hop_headers(response.headers)
+        )
+        stream_response.call_on_close(release)
+
+        return stream_response
+
+    def _request(self, service_info, method, path, headers, args, data):
+        return self._make_stream_response(
+            *self._send_stream(service_info, method, path, headers, args, data)
+        )
+
+    def _defer_request(self, service_info, token, request_backup):
+        if self._identity_signer is None:
+            self._logger.error(
+                f'Failed to defer {request_backup.method} {request_backup.path}, replay requires identity secret'
             )
 
-            # if 500 <= response.status_code <= 599:
-            #     raise RuntimeError('Get 500 code from service')
+            return False
+
+        request_backup.headers = tools.strip_hop_by_hop_headers(
+            request_backup.headers, ['Authorization', InternalIdentitySigner.HEADER]
+        )
+
+        self._replay_queue.push(service_info.name, self._get_username(token), request_backup)
+
+        return True
+
+    def _replay_request(self, service, username, method, path, headers, args, data):
+        service_info = {
+            service_info.name: service_info
+            for service_info in self._get_service_infos()
+        }[service]
+
+        if username is not None:
+            headers[InternalIdentitySigner.HEADER] = self._identity_signer.sign(username)
+
+        return self._send(service_info, method, path, headers, args, data).status_code
+
+    def _send(self, service_info, method, path, headers, args, data):
+        endpoint = self._acquire_endpoint(service_info)
+
+        try:
+            return self._send_to_endpoint(endpoint, method, path, headers, args, data, False)
+
+        finally:
+            service_info.release_endpoint(endpoint)
 
-            self._logger.debug(f'Got response from service, reset error level from {service_info.error_level} to 0')
-            service_info.error_level = 0
+    def _send_stream(self, service_info, method, path, headers, args, data):
+        endpoint = self._acquire_endpoint(service_info)
 
-            if tools.is_json_content(response):
-                return make_response(response.json(), response.status_code)
+        try:
+            response = self._send_to_endpoint(endpoint, method, path, headers, args, data, True)
+
+        except BaseException:
+            service_info.release_endpoint(endpoint)
+
+            raise
+
+        released = False
+        lock = threading.Lock()
+
+        def release():
+            nonlocal released
+
+            with lock:
+                if released:
+                    return
+                released = True
+
+            response.close()
+            service_info.release_endpoint(endpoint)
+
+        return response, release
 
-            return make_response(response.text, response.status_code)
+    def _acquire_endpoint(self, service_info):
+        endpoint = service_info.acquire_endpoint()
+
+        if endpoint is None:
+            self._logger.error(f'Failed to send request to {service_info.name}, no available endpoints')
+
+            raise RuntimeError('Service is unavailable')
+
+        return endpoint
+
+    def _send_to_endpoint(self, endpoint, method, path, headers, args, data, stream):
+        try:
+            self._logger.debug(f'Send request to {endpoint.url}')
+            response = self._http_client.request(
+                method,
+                f'{endpoint.url}{path}',
+                headers=headers,
+                params=args,
+                data=data,
+                stream=stream
+            )
 
         except Exception as exception:
             self._logger.error(f'Failed to send request, error: {exception}')
-
-            service_info.error_level = min(service_info.error_level, self._valid_error_level) + 1
-            self._logger.debug(f'Error level: {service_info.error_level}')
-            self._last_error_time = int(time())
+            endpoint.breaker.record_failure()
 
             raise
 
-    def _check_service_health(self, service_info: ServiceInfo):
-        if service_info.error_level > self._valid_error_level:
-            if service_info.last_error_time + self._wait_before_retry > int(time()):
-                self._logger.error(
-                    f'Failed to send request to {service_info.url}, '
-                    f'error level {service_info.error_level} > {self._valid_error_level} '
-                    f'for {self._wait_before_retry}s from last {service_info.last_error_time}'
-                )
-            
-                return False
-         
+        if response.status_code in UNAVAILABLE_CODES:
+            endpoint.breaker.record_failure()
+        else:
+            endpoint.breaker.record_success()
+
+        return response
+
+    def _start_health_prober(self):
+        if self._health_prober_thread is not None:
+            return
+
+        self._health_prober_thread = threading.Thread(
+            target=self._probe_services_health, name='HealthProber', daemon=True
+        )
+        self._health_prober_thread.start()
+
+    def _probe_services_health(self):
+        while True:
+            for service_info in self._get_service_infos():
+                for endpoint in service_info.endpoints:
+                    self._check_endpoint_health(endpoint)
+
+            time.sleep(self._health_check_interval_s)
+
+    def _check_endpoint_health(self, endpoint):
         try:
-            requests.request('GET', f'{service_info.url}/manage/health')
+            response = self._http_client.request(
+                'GET',
+                f'{endpoint.url}/manage/health',
+                timeout=self._health_check_interval_s
+            )
+            healthy = response.status_code == 200
 
-        except:
-            return False
-        
-        return True
+        except Exception as exception:
+            self._logger.debug(f'Health check for {endpoint.url} failed, error: {exception}')
+            healthy = False
+
+        if healthy != endpoint.healthy:
+            self._logger.info(f'Endpoint {endpoint.url} became {"healthy" if healthy else "unhealthy"}')
+
+        endpoint.healthy = healthy
+        endpoint.last_health_check_time = int(time.time())
+        endpoint.breaker.record_health(healthy)
+
+        return healthy
+
+    def _start_endpoints_refresher(self):
+        if self._endpoints_refresher_thread is not None:
+            return
+
+        if not any(service_info.source.is_dynamic() for service_info in self._get_service_infos()):
+            return
+
+        self._endpoints_refresher_thread = threading.Thread(
+            target=self._refresh_endpoints, name='EndpointsRefresher', daemon=True
+        )
+        self._endpoints_refresher_thread.start()
+
+    def _refresh_endpoints(self):
+        while True:
+            time.sleep(self._endpoints_refresh_interval_s)
+
+            for service_info in self._get_service_infos():
+                if service_info.source.is_dynamic():
+                    service_info.refresh_endpoints()
+
+    def _get_service_infos(self):
+        return [self._flight_service_info, self._ticket_service_info, self._bonus_service_info]
+
+    def _get_metrics(self):
+        metrics = super()._get_metrics()
+
+        metrics['services'] = {
+            service_info.name: {
+                **service_info.stats(),
+                'queue': self._replay_queue.depth(service_info.name)
+            }
+            for service_info in self._get_service_infos()
+        }
+        metrics['replay_queue'] = self._replay_queue.stats()
+
+        if self._response_cache is not None:
+            response_cache = self._response_cache.stats()
+            response_cache['stale_hits'] = self._response_cache_stale_hits
+            response_cache['revalidations'] = self._response_cache_revalidations
+
+            metrics['response_cache'] = response_cache
+
+        metrics['single_flight'] = self._single_flight.stats()
+
+        return metrics
 
     # Helpers
     ####################################################################################################################
@@ -233,6 +603,7 @@ class Gateway(ServerBaseWithAuth0):
         self._register_route('_me')
         self._register_route('_authorize')
         self._register_route('_callback')
+        self._register_route('_manage_cache')
 
 if __name__ == '__main__':
     tools.set_basic_logging_config()
@@ -241,13 +612,38 @@ if __name__ == '__main__':
     parser.add_argument('--host', type=str, default='localhost')
     parser.add_argument('--port', type=int, default=8080)
     parser.add_argument('--flight-service-host', type=str, default='localhost')
+    parser.add_argument('--flight-service-endpoints-file', type=str, default=None)
     parser.add_argument('--flight-service-port', type=int, default=8060)
     parser.add_argument('--bonus-service-host', type=str, default='localhost')
+    parser.add_argument('--bonus-service-endpoints-file', type=str, default=None)
     parser.add_argument('--bonus-service-port', type=int, default=8050)
     parser.add_argument('--ticket-service-host', type=str, default='localhost')
+    parser.add_argument('--ticket-service-endpoints-file', type=str, default=None)
     parser.add_argument('--ticket-service-port', type=int, default=8070)
     parser.add_argument('--valid-error-level', type=int, default=10)
     parser.add_argument('--wait-before-retry', type=int, default=10)
+    parser.add_argument('--breaker-failure-rate', type=float, default=0.5)
+    parser.add_argument('--breaker-window', type=int, default=30)
+    parser.add_argument('--breaker-half-open-probes', type=int, default=1)
+    parser.add_argument('--health-check-interval', type=int, default=5)
+    parser.add_argument('--replay-queue-path', type=str, default='replay_queue.db')
+    parser.add_argument('--replay-workers', type=int, default=4)
+    parser.add_argument('--replay-max-backoff', type=int, default=60)
+    parser.add_argument('--flight-cache-size', type=int, default=1024)
+    parser.add_argument('--flight-cache-ttl', type=int, default=30)
+    parser.add_argument('--flight-cache-stale', type=int, default=60)
+    parser.add_argument('--resolve-dns', action='store_true')
+    parser.add_argument('--endpoints-refresh-interval', type=int, default=30)
+    parser.add_argument('--http-pool-size', type=int, default=50)
+    parser.add_argument('--http-connect-timeout', type=float, default=3)
+    parser.add_argument('--http-read-timeout', type=float, default=10)
+    parser.add_argument('--http-pool-timeout', type=float, default=5)
+    parser.add_argument('--token-cache-size', type=int, default=1024)
+    parser.add_argument('--identity-secret', type=str, default=None)
+    parser.add_argument('--identity-ttl', type=int, default=60)
+    parser.add_argument('--trust-internal-identity', action='store_true')
+    parser.add_argument('--admin-token', type=str, default=None)
+    parser.add_argument('--async-mode', action='store_true')
     parser.add_argument('--debug', action='store_true')
 
     cmd_args = parser.parse_args()
@@ -257,7 +653,12 @@ if __name__ == '__main__':
     else:
         tools.set_basic_logging_config(level=logging.INFO)
 
-    gateway = Gateway(
+    gateway_class = Gateway
+    if cmd_args.async_mode:
+        from async_gateway import AsyncGateway
+        gateway_class = AsyncGateway
+
+    gateway = gateway_class(
         cmd_args.host,
         cmd_args.port,
         cmd_args.flight_service_host,
@@ -270,8 +671,31 @@ if __name__ == '__main__':
         cmd_args.wait_before_retry,
         'cRvxa4PfI6aJTiuOgJoY44qjsj9JFjxx',
         '4yejzOesJYPF-K9P-TIh93w5V4ki0quOIIRuc2MI9WgdUDNCGPj_r6YciYKwjVgg',
-        'dev-r6rulu3m7tph7f63.us.auth0.com'
-        
+        'dev-r6rulu3m7tph7f63.us.auth0.com',
+        breaker_failure_rate=cmd_args.breaker_failure_rate,
+        breaker_window_s=cmd_args.breaker_window,
+        breaker_half_open_probes=cmd_args.breaker_half_open_probes,
+        health_check_interval_s=cmd_args.health_check_interval,
+        replay_queue_path=cmd_args.replay_queue_path,
+        replay_workers=cmd_args.replay_workers,
+        replay_max_backoff_s=cmd_args.replay_max_backoff,
+        flight_cache_size=cmd_args.flight_cache_size,
+        flight_cache_ttl_s=cmd_args.flight_cache_ttl,
+        flight_cache_stale_s=cmd_args.flight_cache_stale,
+        flight_service_endpoints_file=cmd_args.flight_service_endpoints_file,
+        ticket_service_endpoints_file=cmd_args.ticket_service_endpoints_file,
+        bonus_service_endpoints_file=cmd_args.bonus_service_endpoints_file,
+        resolve_dns=cmd_args.resolve_dns,
+        endpoints_refresh_interval_s=cmd_args.endpoints_refresh_interval,
+        http_pool_size=cmd_args.http_pool_size,
+        http_connect_timeout_s=cmd_args.http_connect_timeout,
+        http_read_timeout_s=cmd_args.http_read_timeout,
+        http_pool_timeout_s=cmd_args.http_pool_timeout,
+        token_cache_size=cmd_args.token_cache_size,
+        identity_secret=cmd_args.identity_secret,
+        identity_ttl_s=cmd_args.identity_ttl,
+        trust_internal_identity=cmd_args.trust_internal_identity,
+        admin_token=cmd_args.admin_token
     )
 
     gateway.run(cmd_args.debug)
\ No newline at end of file
@@ -0,0 +1,207 @@
+import logging
+
+import tools
+
+import psycopg2
+
+import argparse
+import hashlib
+import os
+import re
+
+
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d+)_(\w+)\.sql$')
+NO_TRANSACTION_MARK = '-- migrate: no-transaction'
+MIGRATIONS_LOCK_ID = 7100
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+        with open(path, encoding='utf-8') as file:
+            self.sql = file.read()
+
+        self.checksum = hashlib.sha256(self.sql.encode()).hexdigest()
+        self.transactional = not self.sql.lstrip().startswith(NO_TRANSACTION_MARK)
+
+    def statements(self):
+        lines = [line for line in self.sql.splitlines() if not line.strip().startswith('--')]
+
+        return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+def get_migrations(migrations_dir):
+    migrations = {}
+
+    for file_name in sorted(os.listdir(migrations_dir)):
+        match = MIGRATION_FILE_PATTERN.match(file_name)
+
+        if match is None:
+            continue
+
+        version = int(match.group(1))
+
+        if version in migrations:
+            raise RuntimeError(f'Duplicate migration version {version}: {migrations[version].path}, {file_name}')
+
+        migrations[version] = Migration(version, match.group(2), os.path.join(migrations_dir, file_name))
+
+    return [migrations[version] for version in sorted(migrations)]
+
+
+class MigrationRunner:
+    def __init__(self, connection, migrations_dir):
+        self._logger = logging.getLogger('MigrationRunner')
+
+        self._connection = connection
+        self._migrations_dir = migrations_dir
+
+    def migrate(self, target_version=None, dry_run=False):
+        self._connection.autocommit = True
+
+        with self._connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_ID, ))
+
+        try:
+            self._create_migrations_table()
+
+            applied = self._get_applied_migrations()
+            pending = []
+
+            for migration in get_migrations(self._migrations_dir):
+                if target_version is not None and migration.version > target_version:
+                    break
+
+                if migration.version in applied:
+                    if applied[migration.version] != migration.checksum:
+                        self._logger.warning(
+                            f'Migration {os.path.basename(migration.path)} was changed after it had been applied'
+                        )
+                    continue
+
+                pending.append(migration)
+
+            if len(pending) == 0:
+                self._logger.info('Schema is up to date')
+
+            for migration in pending:
+                if dry_run:
+                    self._logger.info(f'Pending migration {os.path.basename(migration.path)}')
+                    continue
+
+                self._logger.info(f'Applying migration {os.path.basename(migration.path)}')
+
+                if migration.transactional:
+                    self._apply_in_transaction(migration)
+                else:
+                    self._apply_without_transaction(migration)
+
+            return pending
+
+        finally:
+            self._connection.autocommit = True
+
+            with self._connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID, ))
+
+    def _create_migrations_table(self):
+        with self._connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS schema_migrations '
+                '( '
+                '    version    INT PRIMARY KEY, '
+                '    name       VARCHAR(255)             NOT NULL, '
+                '    checksum   CHAR(64)                 NOT NULL, '
+                '    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now() '
+                ')'
+            )
+
+    def _get_applied_migrations(self):
+        with self._connection.cursor() as cursor:
+            cursor.execute('SELECT version, checksum FROM schema_migrations')
+
+            return {row[0]: row[1] for row in cursor.fetchall()}
+
+    @staticmethod
+    def _record_migration(cursor, migration):
+        cursor.execute(
+            'INSERT INTO schema_migrations(version, name, checksum) VALUES (%s, %s, %s)',
+            (migration.version, migration.name, migration.checksum)
+        )
+
+    def _apply_in_transaction(self, migration):
+        self._connection.autocommit = False
+
+        try:
+            with self._connection:
+                with self._connection.cursor() as cursor:
+                    cursor.execute(migration.sql)
+                    MigrationRunner._record_migration(cursor, migration)
+        finally:
+            self._connection.autocommit = True
+
+    def _apply_without_transaction(self, migration):
+        with self._connection.cursor() as cursor:
+            for statement in migration.statements():
+                self._logger.debug(f'Execute: {tools.simplify_sql_query(statement)}')
+                cursor.execute(statement)
+
+            cursor.execute(
+                'SELECT indexrelid::regclass::text FROM pg_index '
+                'JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+                'WHERE NOT indisvalid AND pg_class.relnamespace = current_schema()::regnamespace'
+            )
+            invalid_indexes = [row[0] for row in cursor.fetchall()]
+
+            if len(invalid_indexes) != 0:
+                raise RuntimeError(
+                    f'Migration {os.path.basename(migration.path)} left invalid indexes {invalid_indexes}, '
+                    f'drop them and run migrations again'
+                )
+
+            MigrationRunner._record_migration(cursor, migration)
+
+
+def get_default_migrations_dir(database):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'postgres', 'migrations', database)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-host', type=str, default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--db', type=str, required=True)
+    parser.add_argument('--db-user', type=str, required=True)
+    parser.add_argument('--db-password', type=str, required=True)
+    parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--migrations-dir', type=str)
+    parser.add_argument('--target-version', type=int)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--debug', action='store_true')
+
+    cmd_args = parser.parse_args()
+
+    if cmd_args.debug:
+        tools.set_basic_logging_config(level=logging.DEBUG)
+    else:
+        tools.set_basic_logging_config(level=logging.INFO)
+
+    connection = psycopg2.connect(
+        host=cmd_args.db_host,
+        port=cmd_args.db_port,
+        database=cmd_args.db,
+        user=cmd_args.db_user,
+        password=cmd_args.db_password,
+        sslmode=cmd_args.db_sslmode
+    )
+
+    try:
+        MigrationRunner(
+            connection,
+            cmd_args.migrations_dir or get_default_migrations_dir(cmd_args.db)
+        ).migrate(cmd_args.target_version, cmd_args.dry_run)
+    finally:
+        connection.close()
@@ -0,0 +1,190 @@
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+import time
+
+
+RETRY_CODES = [401, 408, 429]
+ALREADY_APPLIED_CODES = [404, 409, 410]
+
+
+class ReplayQueue:
+    def __init__(self, path, send, max_workers=4, base_backoff_s=1, max_backoff_s=60, poll_interval_s=0.5):
+        self._logger = logging.getLogger('ReplayQueue')
+
+        self._path = path
+        self._send = send
+        self._max_workers = max_workers
+        self._base_backoff_s = base_backoff_s
+        self._max_backoff_s = max_backoff_s
+        self._poll_interval_s = poll_interval_s
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS replay_queue ('
+            '    id TEXT PRIMARY KEY,'
+            '    service TEXT NOT NULL,'
+            '    username TEXT,'
+            '    method TEXT NOT NULL,'
+            '    path TEXT NOT NULL,'
+            '    headers TEXT NOT NULL,'
+            '    args TEXT NOT NULL,'
+            '    data BLOB,'
+            '    created_time REAL NOT NULL,'
+            '    attempts INTEGER NOT NULL DEFAULT 0,'
+            '    next_attempt_time REAL NOT NULL'
+            ')'
+        )
+
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(replay_queue)')]
+        if 'username' not in columns:
+            self._connection.execute('ALTER TABLE replay_queue ADD COLUMN username TEXT')
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ReplayQueue')
+        self._in_flight = set()
+        self._wake_up = threading.Event()
+        self._worker_thread = None
+
+        self._replayed = 0
+        self._dropped = 0
+        self._failed_attempts = 0
+        self._last_replay_latency_s = 0
+        self._max_replay_latency_s = 0
+
+    def start(self):
+        if self._worker_thread is not None:
+            return
+
+        self._logger.info(f'Start replay queue \'{self._path}\' with {self.depth()} deferred requests')
+
+        self._worker_thread = threading.Thread(target=self._drain, name='ReplayQueue', daemon=True)
+        self._worker_thread.start()
+
+    def push(self, service, username, request_backup):
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute(
+                'INSERT INTO replay_queue'
+                '(id, service, username, method, path, headers, args, data, created_time, next_attempt_time) '
+                'VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    str(uuid.uuid4()),
+                    service,
+                    username,
+                    request_backup.method,
+                    request_backup.path,
+                    json.dumps(dict(request_backup.headers)),
+                    json.dumps(dict(request_backup.args)),
+                    request_backup.data,
+                    now,
+                    now
+                )
+            )
+
+        self._wake_up.set()
+
+    def depth(self, service=None):
+        with self._lock:
+            if service is None:
+                return self._connection.execute('SELECT COUNT(*) FROM replay_queue').fetchone()[0]
+
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM replay_queue WHERE service = ?', (service,)
+            ).fetchone()[0]
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'in_flight': len(self._in_flight),
+            'replayed': self._replayed,
+            'dropped': self._dropped,
+            'failed_attempts': self._failed_attempts,
+            'last_replay_latency_s': self._last_replay_latency_s,
+            'max_replay_latency_s': self._max_replay_latency_s
+        }
+
+    def _drain(self):
+        while True:
+            self._wake_up.wait(self._poll_interval_s)
+            self._wake_up.clear()
+
+            try:
+                for row in self._get_due_requests():
+                    self._in_flight.add(row[0])
+                    self._executor.submit(self._replay, row)
+
+            except Exception as exception:
+                self._logger.error(f'Failed to read replay queue, error: {exception}')
+
+    def _get_due_requests(self):
+        free_workers = self._max_workers - len(self._in_flight)
+
+        if free_workers <= 0:
+            return []
+
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT id, service, username, method, path, headers, args, data, created_time, attempts FROM replay_queue '
+                'WHERE next_attempt_time <= ? ORDER BY created_time LIMIT ?',
+                (time.time(), free_workers + len(self._in_flight))
+            ).fetchall()
+
+        return [row for row in rows if row[0] not in self._in_flight][:free_workers]
+
+    def _replay(self, row):
+        id, service, username, method, path, headers, args, data, created_time, attempts = row
+
+        try:
+            self._logger.debug(f'Replay {method} {path} to {service}, attempt {attempts + 1}')
+
+            headers = json.loads(headers)
+            headers.setdefault('Idempotency-Key', id)
+
+            status_code = self._send(service, username, method, path, headers, json.loads(args), data)
+
+        except Exception as exception:
+            self._logger.error(f'Failed to replay {method} {path} to {service}, error: {exception}')
+
+            status_code = None
+
+        try:
+            if status_code is None or status_code >= 500 or status_code in RETRY_CODES:
+                self._failed_attempts += 1
+                backoff_s = min(self._base_backoff_s * 2 ** attempts, self._max_backoff_s)
+
+                with self._lock:
+                    self._connection.execute(
+                        'UPDATE replay_queue SET attempts = attempts + 1, next_attempt_time = ? WHERE id = ?',
+                        (time.time() + backoff_s, id)
+                    )
+
+            elif status_code < 400 or status_code in ALREADY_APPLIED_CODES:
+                latency_s = time.time() - created_time
+
+                self._replayed += 1
+                self._last_replay_latency_s = latency_s
+                self._max_replay_latency_s = max(self._max_replay_latency_s, latency_s)
+
+                self._delete(id)
+
+            else:
+                self._logger.error(f'Drop deferred {method} {path} to {service}, rejected with {status_code}')
+                self._dropped += 1
+
+                self._delete(id)
+
+        finally:
+            self._in_flight.discard(id)
+            self._wake_up.set()
+
+    def _delete(self, id):
+        with self._lock:
+            self._connection.execute('DELETE FROM replay_queue WHERE id = ?', (id,))
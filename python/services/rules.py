@@ -14,4 +14,16 @@ def json_content(content_type):
     if content_type != 'application/json':
         return 'Invalid header: \'Content-Type\''
     
-    return None
\ No newline at end of file
+    return None
+
+def json_object(value):
+    if not isinstance(value, dict):
+        return 'Value must be object'
+
+    return None
+
+def not_empty(value):
+    if len(value) == 0:
+        return 'Value must be not empty'
+
+    return None
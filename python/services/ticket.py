@@ -5,99 +5,241 @@ from base import DbConnectorBase
 
 from flask import request
 from flask import make_response
+from flask import Response
+
+from werkzeug.http import http_date
+from werkzeug.http import parse_date
+
+from psycopg2.extras import execute_values
 
 import argparse
 
-import requests
 
 import uuid
 import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from time import monotonic
+from time import time
+from time import sleep
+
+import requests
 
 import tools
 import errors
+from cache import TtlLruCache
+from cache import SingleFlight
 import rules
 from getters import UserValue
 from getters import ServerValue
 
 class TicketDbConnector(DbConnectorBase):
-    def __init__(self, host, port, database, user, password, sslmode='disable'):
-        super().__init__('TicketDbConnector', host, port, database, user, password, sslmode)
+    TICKET_COLUMNS = 'id, uid, username, flight_number, price, status, from_airport, to_airport, flight_date'
+
+    STATEMENTS = {
+        'get_user_tickets': f'SELECT {TICKET_COLUMNS} FROM ticket WHERE username = $1 ORDER BY id',
+        'get_user_tickets_page': f'SELECT {TICKET_COLUMNS} FROM ticket WHERE username = $1 AND id > $2 ORDER BY id LIMIT $3',
+        'get_ticket_by_uid': f'SELECT {TICKET_COLUMNS} FROM ticket WHERE uid = $1',
+        'get_user_tickets_by_uids': f'SELECT {TICKET_COLUMNS} FROM ticket WHERE username = $1 AND uid = ANY($2)',
+        'add_user_ticket': (
+            'INSERT INTO ticket(username, uid, flight_number, price, status, from_airport, to_airport, flight_date) '
+            'VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT (uid) DO NOTHING'
+        ),
+        'cancel_user_ticket': 'UPDATE ticket SET status = \'CANCELED\' WHERE username = $1 AND uid = $2',
+        'cancel_user_tickets': 'UPDATE ticket SET status = \'CANCELED\' WHERE username = $1 AND uid = ANY($2)',
+        'get_flight_numbers_without_snapshot': 'SELECT DISTINCT flight_number FROM ticket WHERE flight_date IS NULL',
+        'set_flight_snapshot': (
+            'UPDATE ticket SET from_airport = $1, to_airport = $2, flight_date = $3 '
+            'WHERE flight_number = $4 AND flight_date IS NULL'
+        ),
+        'claim_idempotency_key': (
+            'INSERT INTO idempotency_key(username, key, request_hash, ticket_uid) VALUES ($1, $2, $3, $4) '
+            'ON CONFLICT (username, key) DO UPDATE SET '
+            '    request_hash = EXCLUDED.request_hash, '
+            '    response_code = NULL, '
+            '    response_body = NULL, '
+            '    ticket_uid = CASE '
+            '        WHEN idempotency_key.response_code IS NULL AND idempotency_key.request_hash = EXCLUDED.request_hash '
+            '        THEN COALESCE(idempotency_key.ticket_uid, EXCLUDED.ticket_uid) '
+            '        ELSE EXCLUDED.ticket_uid '
+            '    END, '
+            '    created_at = now() '
+            'WHERE '
+            '    (idempotency_key.response_code IS NULL AND idempotency_key.created_at < now() - make_interval(secs => $5)) '
+            '    OR idempotency_key.created_at < now() - make_interval(secs => $6) '
+            'RETURNING ticket_uid'
+        ),
+        'get_idempotency_key': (
+            'SELECT request_hash, response_code, response_body FROM idempotency_key WHERE username = $1 AND key = $2'
+        ),
+        'complete_idempotency_key': (
+            'UPDATE idempotency_key SET response_code = $1, response_body = $2 WHERE username = $3 AND key = $4'
+        ),
+        'release_idempotency_key': (
+            'DELETE FROM idempotency_key WHERE username = $1 AND key = $2 AND response_code IS NULL'
+        ),
+        'purge_idempotency_keys': 'DELETE FROM idempotency_key WHERE created_at < now() - make_interval(secs => $1)'
+    }
 
-    def get_user_tickets(self, user):
-        query = tools.simplify_sql_query(
-            f'SELECT id, uid, username, flight_number, price, status FROM ticket WHERE username = \'{user}\''
-        )
+    def __init__(self, host, port, database, user, password, sslmode='disable', **kwargs):
+        super().__init__('TicketDbConnector', host, port, database, user, password, sslmode, **kwargs)
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+    @staticmethod
+    def _make_ticket(row):
+        return {
+            'id': row[0],
+            'uid': row[1],
+            'username': row[2],
+            'flight_number': row[3],
+            'price': row[4],
+            'status': row[5],
+            'from_airport': row[6],
+            'to_airport': row[7],
+            'flight_date': None if row[8] is None else http_date(row[8])
+        }
 
-        table = cursor.fetchall()
-        cursor.close()
+    def get_user_tickets(self, user, after_id=None, limit=None):
+        if after_id is None and limit is None:
+            table = self._fetch_all('get_user_tickets', user)
+        else:
+            table = self._fetch_all('get_user_tickets_page', user, after_id or 0, limit)
 
-        return [
-            {
-                'id': row[0],
-                'uid': row[1],
-                'username': row[2],
-                'flight_number': row[3],
-                'price': row[4],
-                'status': row[5]
-            }
-            for row in table
-        ]
+        return [TicketDbConnector._make_ticket(row) for row in table]
 
-    def get_ticket_by_uid(self, uid):
-        query = tools.simplify_sql_query(
-            f'SELECT id, uid, username, flight_number, price, status FROM ticket WHERE uid = \'{uid}\''
-        )
+    def iter_user_tickets(self, user, fetch_size=100):
+        after_id = None
+
+        while True:
+            table = self.get_user_tickets(user, after_id, fetch_size)
+            if len(table) == 0:
+                break
+
+            yield table
+
+            if len(table) < fetch_size:
+                break
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+            after_id = table[-1]['id']
 
-        row = cursor.fetchone()
-        cursor.close()
+    def get_ticket_by_uid(self, uid):
+        row = self._fetch_one('get_ticket_by_uid', uid)
 
         if row is None:
             return None
 
-        return {
-            'id': row[0],
-            'uid': row[1],
-            'username': row[2],
-            'flight_number': row[3],
-            'price': row[4],
-            'status': row[5]
-        }
+        return TicketDbConnector._make_ticket(row)
+
+    def add_user_ticket(self, user, uid, flight_number, price, status, from_airport=None, to_airport=None, flight_date=None):
+        self._modify(
+            'add_user_ticket',
+            user,
+            uid,
+            flight_number,
+            price,
+            status,
+            from_airport,
+            to_airport,
+            None if flight_date is None else parse_date(flight_date)
+        )
 
-    def add_user_ticket(self, user, uid, flight_number, price, status):
+    def cancel_user_ticket(self, user, uid):
+        self._modify('cancel_user_ticket', user, uid)
+
+    def add_user_tickets(self, user, tickets):
         query = tools.simplify_sql_query(
-            f'INSERT INTO ticket(username, uid, flight_number, price, status) '
-            f'VALUES (\'{user}\', \'{uid}\', \'{flight_number}\', {price}, \'{status}\')'
+            'INSERT INTO ticket(username, uid, flight_number, price, status, from_airport, to_airport, flight_date) '
+            'VALUES %s ON CONFLICT (uid) DO NOTHING'
         )
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+        self._logger.debug(f'Execute query: {query}, rows: {len(tickets)}')
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            execute_values(
+                cursor,
+                query,
+                [
+                    (
+                        user,
+                        ticket['uid'],
+                        ticket['flight_number'],
+                        ticket['price'],
+                        ticket['status'],
+                        ticket['from_airport'],
+                        ticket['to_airport'],
+                        None if ticket['flight_date'] is None else parse_date(ticket['flight_date'])
+                    )
+                    for ticket in tickets
+                ]
+            )
 
-        cursor.close()
-        self._connection.commit()
+            cursor.close()
+            connection.commit()
 
-    def cancel_user_ticket(self, user, uid):
-        query = tools.simplify_sql_query(
-            f'UPDATE ticket SET status = \'CANCELED\' WHERE username = \'{user}\' AND uid = \'{uid}\''
-        )
+    def get_user_tickets_by_uids(self, user, uids):
+        table = self._fetch_all('get_user_tickets_by_uids', user, [uuid.UUID(uid) for uid in uids])
+
+        return [TicketDbConnector._make_ticket(row) for row in table]
+
+    def cancel_user_tickets(self, user, uids):
+        return self._modify('cancel_user_tickets', user, [uuid.UUID(uid) for uid in uids])
+
+    def get_flight_numbers_without_snapshot(self):
+        return [row[0] for row in self._fetch_all('get_flight_numbers_without_snapshot')]
+
+    def set_flight_snapshot(self, flight_number, from_airport, to_airport, flight_date):
+        return self._modify('set_flight_snapshot', from_airport, to_airport, flight_date, flight_number)
+
+    def claim_idempotency_key(self, user, key, request_hash, ticket_uid, stale_after_s, ttl_s):
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(
+                cursor, 'claim_idempotency_key', user, key, request_hash, uuid.UUID(ticket_uid), stale_after_s, ttl_s
+            )
 
-        self._logger.debug(f'Execute query: {query}')
-        cursor = self._connection.cursor()
-        cursor.execute(query)
+            row = cursor.fetchone()
+            claimed = row is not None
 
-        cursor.close()
-        self._connection.commit()
+            if claimed:
+                ticket_uid = str(row[0])
+            else:
+                self._execute(cursor, 'get_idempotency_key', user, key)
+                row = cursor.fetchone()
+
+            cursor.close()
+            connection.commit()
+
+        if claimed or row is None:
+            return ticket_uid, None
+
+        return ticket_uid, {
+            'request_hash': row[0],
+            'response_code': row[1],
+            'response_body': row[2]
+        }
+
+    def complete_idempotency_key(self, user, key, response_code, response_body):
+        self._modify('complete_idempotency_key', response_code, response_body, user, key)
+
+    def release_idempotency_key(self, user, key):
+        self._modify('release_idempotency_key', user, key)
+
+    def purge_idempotency_keys(self, ttl_s):
+        return self._modify('purge_idempotency_keys', ttl_s)
 
 
 class TicketService(ServerBaseWithAuth0):
+    FLIGHTS_BATCH_SIZE = 100
+    DEFAULT_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+    MAX_BATCH_SIZE = 100
+    NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+    IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+    MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+    _NOT_CACHED = object()
+
     def __init__(
         self, 
         host, 
@@ -109,7 +251,15 @@ class TicketService(ServerBaseWithAuth0):
         bonus_service_port,
         authorize_service_api_key,
         authorize_service_secret_key,
-        authorize_service_url
+        authorize_service_url,
+        fanout_workers=16,
+        request_deadline_s=10,
+        flight_cache_size=4096,
+        flight_cache_ttl_s=300,
+        flight_cache_negative_ttl_s=30,
+        idempotency_ttl_s=86400,
+        idempotency_purge_interval_s=3600,
+        **kwargs
     ):
         super().__init__(
             authorize_service_api_key, 
@@ -118,12 +268,29 @@ class TicketService(ServerBaseWithAuth0):
             'TicketService', 
             host, 
             port, 
-            db_connector
+            db_connector,
+            **kwargs
         )
 
         self._flight_service_url = f'http://{flight_service_host}:{flight_service_port}'
         self._bonus_service_url = f'http://{bonus_service_host}:{bonus_service_port}'
 
+        self._request_deadline_s = request_deadline_s
+        self._fanout_executor = ThreadPoolExecutor(max_workers=fanout_workers, thread_name_prefix='TicketServiceFanout')
+
+        self._flight_cache = TtlLruCache(flight_cache_size, flight_cache_ttl_s)
+        self._flight_cache_negative_ttl_s = flight_cache_negative_ttl_s
+
+        self._purchase_single_flight = SingleFlight()
+        self._idempotency_ttl_s = idempotency_ttl_s
+        self._idempotency_purge_interval_s = idempotency_purge_interval_s
+        self._idempotency_keys_purger_thread = None
+
+    def run(self, debug=False):
+        self._start_idempotency_keys_purger()
+
+        super().run(debug)
+
     # API requests handlers
     ####################################################################################################################
 
@@ -135,27 +302,31 @@ class TicketService(ServerBaseWithAuth0):
             token = self._get_user_token(request)
             username = self._get_username(token)
 
-            table = self._db_connector.get_user_tickets(username)
+            if request.accept_mimetypes.best == TicketService.NDJSON_CONTENT_TYPE:
+                return Response(
+                    self._stream_user_tickets(username, self._get_auth_headers(token)),
+                    200,
+                    content_type=TicketService.NDJSON_CONTENT_TYPE
+                )
+
+            deadline = self._get_deadline()
+            page = self._get_page_args(request.args)
+
+            table, next_cursor = self._get_user_tickets(username, page)
             
-            meesage = []
-            for row in table:
-                flight = requests.request('GET', f'{self._flight_service_url}/api/v1/flights/{row["flight_number"]}', headers={'Authorization': f'Bearer {token}'}).json()
-                if 'error' in flight.keys():
-                    raise errors.ServerError(flight, 500)
+            meesage = self._make_ticket_messages(table, self._get_auth_headers(token), deadline)
 
-                meesage.append(
-                    {
-                        'ticketUid': row['uid'],
-                        'fromAirport': flight['fromAirport'],
-                        'toAirport': flight['toAirport'],
-                        'date': flight['date'],
-                        'price': row['price'],
-                        'status': row['status'],
-                        'flightNumber': flight['flightNumber']
-                    }
-                )
+            if page is None:
+                return make_response(meesage, 200)
 
-            return make_response(meesage, 200)
+            return make_response(
+                {
+                    'pageSize': page['size'],
+                    'items': meesage,
+                    'nextCursor': next_cursor
+                },
+                200
+            )
 
         if method == 'POST':
             token = self._get_user_token(request)
@@ -169,73 +340,99 @@ class TicketService(ServerBaseWithAuth0):
                 price = UserValue.get_from(body, 'price', error_chain).expected(int).rule(rules.grater_zero).value
                 paid_from_balance = UserValue.get_from(body, 'paidFromBalance', error_chain).expected(bool).value
 
-            flight = requests.request('GET', f'{self._flight_service_url}/api/v1/flights/{flight_number}', headers={'Authorization': f'Bearer {token}'}).json()
-            if 'error' in flight.keys():
-                raise errors.ServerError(flight, 500)
+            auth_headers = self._get_auth_headers(token)
 
-            price = ServerValue.get_from(flight, 'price').expected(int).rule(rules.grater_zero).value
-
-            privilege = requests.request('GET', f'{self._bonus_service_url}/api/v1/privilege', headers={'Authorization': f'Bearer {token}'}).json()
-            if 'error' in privilege.keys():
-                raise errors.ServerError(privilege, 500)
+            return self._make_purchase_response(
+                username,
+                body,
+                lambda ticket_uid, progress: self._purchase_ticket(
+                    username, auth_headers, flight_number, paid_from_balance, ticket_uid, progress
+                )
+            )
 
-            bonus_balance = ServerValue.get_from(privilege, 'balance').expected(int).rule(rules.greate_equal_zero).value
-            
-            if bonus_balance == 0:
-                paid_from_balance = False
+        assert False, 'Invalid request method'
 
-            if paid_from_balance:
-                paid_by_bonuses = min(price, bonus_balance)
-                balance_diff = paid_by_bonuses
-            else:
-                paid_by_bonuses = 0
-                balance_diff = int(price / 10)
-                
-            paid_by_money = price - bonus_balance
+    @ServerBaseWithAuth0.route(path='/api/v1/tickets/batch', methods=['POST'])
+    def _api_v1_tickets_batch(self):
+        method = request.method
 
-            uid = str(uuid.uuid4())
+        if method == 'POST':
+            token = self._get_user_token(request)
+            username = self._get_username(token)
 
-            privilege = requests.request(
-                'POST',
-                f'{self._bonus_service_url}/api/v1/privilege/{uid}',
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {token}'
-                },
-                data=json.dumps({
-                    'paidFromBalance': paid_from_balance,
-                    'datetime': ServerBaseWithAuth0.get_current_datetime(),
-                    'ticketUid': uid,
-                    'balanceDiff': balance_diff
-                })
-            ).json()
+            UserValue.get_from(request.headers, 'Content-Type').rule(rules.json_content)
+            body = request.json
 
-            if 'error' in privilege.keys():
-                return make_response(privilege, 500)
+            purchases = []
+            for item in TicketService._get_batch_items(body, 'tickets'):
+                UserValue('tickets', item).rule(rules.json_object)
 
-            self._db_connector.add_user_ticket(username, uid, flight_number, price, 'PAID')
+                with UserValue.ErrorChain() as error_chain:
+                    flight_number = UserValue.get_from(item, 'flightNumber', error_chain).expected(str).value
+                    UserValue.get_from(item, 'price', error_chain).expected(int).rule(rules.grater_zero)
+                    paid_from_balance = UserValue.get_from(item, 'paidFromBalance', error_chain).expected(bool).value
 
-            return make_response(
-                {
-                    'ticketUid': uid,
-                    'flightNumber': flight_number,
-                    'fromAirport': flight['fromAirport'],
-                    'toAirport': flight['toAirport'],
-                    'date': flight['date'],
-                    'price': price,
-                    'paidByMoney': paid_by_money,
-                    'paidByBonuses': paid_by_bonuses,
-                    'status': 'PAID',
-                    'privilege': {
-                        'balance': privilege['balance'],
-                        'status': privilege['status']
+                purchases.append(
+                    {
+                        'flight_number': flight_number,
+                        'paid_from_balance': paid_from_balance
                     }
-                },
-                200
+                )
+
+            auth_headers = self._get_auth_headers(token)
+
+            return self._make_purchase_response(
+                username,
+                body,
+                lambda ticket_uid, progress: self._purchase_tickets(username, auth_headers, purchases, ticket_uid, progress)
             )
 
         assert False, 'Invalid request method'
 
+    @ServerBaseWithAuth0.route(path='/api/v1/tickets/batch/cancel', methods=['POST'])
+    def _api_v1_tickets_batch_cancel(self):
+        method = request.method
+
+        if method == 'POST':
+            token = self._get_user_token(request)
+            username = self._get_username(token)
+
+            UserValue.get_from(request.headers, 'Content-Type').rule(rules.json_content)
+
+            uids = list(dict.fromkeys(
+                str(UserValue('ticketUids', uid).expected(str).cast_to(uuid.UUID).value)
+                for uid in TicketService._get_batch_items(request.json, 'ticketUids')
+            ))
+
+            tickets = self._db_connector.get_user_tickets_by_uids(username, uids)
+
+            missed = sorted(set(uids) - set(str(ticket['uid']) for ticket in tickets))
+            if len(missed) != 0:
+                raise errors.UserError({'message': 'non existent tickets', 'ticketUids': missed}, 404)
+
+            paid_uids = [str(ticket['uid']) for ticket in tickets if ticket['status'] == 'PAID']
+
+            if len(paid_uids) != 0:
+                privilege = self._http_client.request(
+                    'POST',
+                    f'{self._bonus_service_url}/api/v1/privilege/batch/cancel',
+                    headers={
+                        'Content-Type': 'application/json',
+                        **self._get_auth_headers(token)
+                    },
+                    timeout=self._get_timeout(self._get_deadline()),
+                    data=json.dumps({'ticketUids': paid_uids})
+                ).json()
+
+                if 'error' in privilege.keys():
+                    return make_response(privilege, 500)
+
+                self._db_connector.cancel_user_tickets(username, paid_uids)
+
+            return make_response('', 204)
+
+        assert False, 'Invalid request method'
+
     @ServerBaseWithAuth0.route(path='/api/v1/tickets/<string:uid>', methods=['GET', 'DELETE'])
     def _api_v1_tickets_aUid(self, uid):
         method = request.method
@@ -248,22 +445,9 @@ class TicketService(ServerBaseWithAuth0):
             if ticket is None:
                 raise errors.UserError({'message': 'non existent ticket'}, 404)
 
-            url_base = f'{self._flight_service_url}/api/v1/flights'
+            message, = self._make_ticket_messages([ticket], self._get_auth_headers(token), self._get_deadline())
 
-            flight = requests.request('GET', f'{url_base}/{ticket["flight_number"]}', headers={'Authorization': f'Bearer {token}'}).json()
-
-            return make_response(
-                {
-                    'ticketUid': ticket['uid'],
-                    'fromAirport': flight['fromAirport'],
-                    'toAirport': flight['toAirport'],
-                    'date': flight['date'],
-                    'price': ticket['price'],
-                    'status': ticket['status'],
-                    'flightNumber': flight['flightNumber']
-                },
-                200
-            )
+            return make_response(message, 200)
 
         if method == 'DELETE':
             token = self._get_user_token(request)
@@ -274,12 +458,12 @@ class TicketService(ServerBaseWithAuth0):
             if ticket is None:
                 raise errors.UserError({'message': 'non existent ticket'}, 404)
 
-            privilege = requests.request(
+            privilege = self._http_client.request(
                 'DELETE',
                 f'{self._bonus_service_url}/api/v1/privilege/{uid}',
                 headers={
                     'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {token}'
+                    **self._get_auth_headers(token)
                 }
             )
 
@@ -301,45 +485,540 @@ class TicketService(ServerBaseWithAuth0):
             token = self._get_user_token(request)
             username = self._get_username(token)
 
-            privilege = requests.request('GET', f'{self._bonus_service_url}/api/v1/privilege', headers={'Authorization': f'Bearer {token}'}).json()
-            if 'error' in privilege.keys():
-                raise errors.ServerError(privilege, 500)
+            deadline = self._get_deadline()
+            auth_headers = self._get_auth_headers(token)
+
+            page = self._get_page_args(request.args)
+
+            privilege_future = self._fanout_executor.submit(self._get_privilege, auth_headers, deadline)
 
-            table = self._db_connector.get_user_tickets(username)
+            table, next_cursor = self._get_user_tickets(username, page)
             
-            ticktes = []
-            for row in table:
-                flight = requests.request('GET', f'{self._flight_service_url}/api/v1/flights/{row["flight_number"]}', headers={'Authorization': f'Bearer {token}'}).json()
-                if 'error' in flight.keys():
-                    raise errors.ServerError(flight, 500)
+            ticktes = self._make_ticket_messages(table, auth_headers, deadline)
+
+            privilege, = self._wait_all([privilege_future], deadline)
 
-                ticktes.append(
-                    {
-                        'ticketUid': row['uid'],
-                        'fromAirport': flight['fromAirport'],
-                        'toAirport': flight['toAirport'],
-                        'date': flight['date'],
-                        'price': row['price'],
-                        'status': row['status'],
-                        'flightNumber': flight['flightNumber']
-                    }
-                )
             message = {
                 'tickets': ticktes,
                 'privilege': privilege
             }
 
+            if page is not None:
+                message['pageSize'] = page['size']
+                message['nextCursor'] = next_cursor
+
             return make_response(message, 200)
 
         assert False, 'Invalid request method'
 
+    @ServerBaseWithAuth0.route(path='/manage/flight-cache', methods=['DELETE'])
+    def _manage_flight_cache(self):
+        self._check_admin_token(request.headers)
+
+        number = request.args.get('number')
+
+        if number is None:
+            purged = len(self._flight_cache)
+            self.clear_flight_cache()
+        else:
+            purged = self.invalidate_flight(number)
+
+        self._logger.info(f'Purged {purged} cached flights')
+
+        return make_response({'purged': purged}, 200)
+
+    # Flight cache
+    ####################################################################################################################
+
+    def invalidate_flight(self, number):
+        return self._flight_cache.purge(lambda key: key == number)
+
+    def clear_flight_cache(self):
+        self._flight_cache.clear()
+
     # Helpers
     ####################################################################################################################
 
+    @staticmethod
+    def _make_ticket_message(ticket, flight=None):
+        if flight is None:
+            flight = {
+                'fromAirport': ticket['from_airport'],
+                'toAirport': ticket['to_airport'],
+                'date': ticket['flight_date'],
+                'flightNumber': ticket['flight_number']
+            }
+
+        return {
+            'ticketUid': ticket['uid'],
+            'fromAirport': flight['fromAirport'],
+            'toAirport': flight['toAirport'],
+            'date': flight['date'],
+            'price': ticket['price'],
+            'status': ticket['status'],
+            'flightNumber': flight['flightNumber']
+        }
+
+    def _make_ticket_messages(self, table, auth_headers, deadline):
+        flights = self._get_flights(
+            [row['flight_number'] for row in table if row['flight_date'] is None], auth_headers, deadline
+        )
+
+        return [
+            TicketService._make_ticket_message(row, None if row['flight_date'] is not None else flights[row['flight_number']])
+            for row in table
+        ]
+
+    @staticmethod
+    def _get_batch_items(body, name):
+        UserValue('body', body).rule(rules.json_object)
+
+        items = UserValue.get_from(body, name).expected(list).rule(rules.not_empty).value
+
+        if len(items) > TicketService.MAX_BATCH_SIZE:
+            raise errors.UserError({name: f'Too many values, max {TicketService.MAX_BATCH_SIZE}'}, 400)
+
+        return items
+
+    @staticmethod
+    def _get_page_args(args):
+        if 'size' not in args and 'cursor' not in args:
+            return None
+
+        page = {'size': TicketService.DEFAULT_PAGE_SIZE, 'cursor': None}
+
+        with UserValue.ErrorChain() as error_chain:
+            if 'size' in args:
+                page['size'] = UserValue.get_from(args, 'size', error_chain).cast_to_int().rule(rules.grater_zero).value
+            if 'cursor' in args:
+                page['cursor'] = UserValue.get_from(args, 'cursor', error_chain).cast_to_int().rule(rules.grater_zero).value
+
+        page['size'] = min(page['size'], TicketService.MAX_PAGE_SIZE)
+
+        return page
+
+    def _get_user_tickets(self, username, page):
+        if page is None:
+            return self._db_connector.get_user_tickets(username), None
+
+        table = self._db_connector.get_user_tickets(username, page['cursor'], page['size'] + 1)
+
+        if len(table) <= page['size']:
+            return table, None
+
+        table = table[:page['size']]
+        return table, table[-1]['id']
+
+    def _stream_user_tickets(self, username, auth_headers):
+        try:
+            for table in self._db_connector.iter_user_tickets(username, TicketService.FLIGHTS_BATCH_SIZE):
+                yield ''.join(
+                    json.dumps(message) + '\n' for message in self._make_ticket_messages(table, auth_headers, self._get_deadline())
+                )
+
+        except errors.ServerError as error:
+            self._logger.error(f'Failed to stream tickets for user \'{username}\': {error.message}')
+            yield json.dumps(error.message) + '\n'
+
+    def _purchase_ticket(self, username, auth_headers, flight_number, paid_from_balance, uid, progress):
+        deadline = self._get_deadline()
+
+        flight, privilege = self._wait_all(
+            [
+                self._fanout_executor.submit(self._get_flight, flight_number, auth_headers, deadline),
+                self._fanout_executor.submit(self._get_privilege, auth_headers, deadline)
+            ],
+            deadline
+        )
+
+        self._flight_cache.put(flight_number, flight)
+
+        price = ServerValue.get_from(flight, 'price').expected(int).rule(rules.grater_zero).value
+
+        bonus_balance = ServerValue.get_from(privilege, 'balance').expected(int).rule(rules.greate_equal_zero).value
+        
+        if bonus_balance == 0:
+            paid_from_balance = False
+
+        if paid_from_balance:
+            paid_by_bonuses = min(price, bonus_balance)
+            balance_diff = paid_by_bonuses
+        else:
+            paid_by_bonuses = 0
+            balance_diff = int(price / 10)
+            
+        paid_by_money = price - bonus_balance
+
+        progress['bonus_requested'] = True
+
+        response = self._http_client.request(
+            'POST',
+            f'{self._bonus_service_url}/api/v1/privilege/{uid}',
+            headers={
+                'Content-Type': 'application/json',
+                **auth_headers
+            },
+            timeout=self._get_timeout(deadline),
+            data=json.dumps({
+                'paidFromBalance': paid_from_balance,
+                'datetime': ServerBaseWithAuth0.get_current_datetime(),
+                'ticketUid': uid,
+                'balanceDiff': balance_diff
+            })
+        )
+        privilege = response.json()
+
+        if 'error' in privilege.keys():
+            return privilege, 409 if response.status_code == 409 else 500
+
+        self._db_connector.add_user_ticket(
+            username, uid, flight_number, price, 'PAID', flight['fromAirport'], flight['toAirport'], flight['date']
+        )
+
+        return (
+            {
+                'ticketUid': uid,
+                'flightNumber': flight_number,
+                'fromAirport': flight['fromAirport'],
+                'toAirport': flight['toAirport'],
+                'date': flight['date'],
+                'price': price,
+                'paidByMoney': paid_by_money,
+                'paidByBonuses': paid_by_bonuses,
+                'status': 'PAID',
+                'privilege': {
+                    'balance': privilege['balance'],
+                    'status': privilege['status']
+                }
+            },
+            200
+        )
+
+    def _purchase_tickets(self, username, auth_headers, purchases, ticket_uid, progress):
+        deadline = self._get_deadline()
+
+        flights, privilege = self._wait_all(
+            [
+                self._fanout_executor.submit(
+                    self._get_flights_batch,
+                    list(dict.fromkeys(purchase['flight_number'] for purchase in purchases)),
+                    auth_headers,
+                    deadline
+                ),
+                self._fanout_executor.submit(self._get_privilege, auth_headers, deadline)
+            ],
+            deadline
+        )
+
+        flights = {flight['flightNumber']: flight for flight in flights}
+
+        missed = sorted(set(purchase['flight_number'] for purchase in purchases) - set(flights.keys()))
+        if len(missed) != 0:
+            raise errors.UserError({'message': 'non existent flights', 'flightNumbers': missed}, 404)
+
+        for number, flight in flights.items():
+            self._flight_cache.put(number, flight)
+
+        bonus_balance = ServerValue.get_from(privilege, 'balance').expected(int).rule(rules.greate_equal_zero).value
+        datetime = ServerBaseWithAuth0.get_current_datetime()
+
+        tickets = []
+        operations = []
+        for index, purchase in enumerate(purchases):
+            flight = flights[purchase['flight_number']]
+            price = ServerValue.get_from(flight, 'price').expected(int).rule(rules.grater_zero).value
+
+            paid_from_balance = purchase['paid_from_balance'] and bonus_balance != 0
+
+            if paid_from_balance:
+                paid_by_bonuses = min(price, bonus_balance)
+                balance_diff = paid_by_bonuses
+                bonus_balance -= paid_by_bonuses
+            else:
+                paid_by_bonuses = 0
+                balance_diff = int(price / 10)
+                bonus_balance += balance_diff
+
+            uid = str(uuid.uuid5(uuid.UUID(ticket_uid), str(index)))
+
+            tickets.append(
+                {
+                    'uid': uid,
+                    'flight_number': purchase['flight_number'],
+                    'price': price,
+                    'status': 'PAID',
+                    'from_airport': flight['fromAirport'],
+                    'to_airport': flight['toAirport'],
+                    'flight_date': flight['date'],
+                    'paid_by_money': price - paid_by_bonuses,
+                    'paid_by_bonuses': paid_by_bonuses
+                }
+            )
+            operations.append(
+                {
+                    'paidFromBalance': paid_from_balance,
+                    'datetime': datetime,
+                    'ticketUid': uid,
+                    'balanceDiff': balance_diff
+                }
+            )
+
+        progress['bonus_requested'] = True
+
+        response = self._http_client.request(
+            'POST',
+            f'{self._bonus_service_url}/api/v1/privilege/batch',
+            headers={
+                'Content-Type': 'application/json',
+                **auth_headers
+            },
+            timeout=self._get_timeout(deadline),
+            data=json.dumps({'items': operations})
+        )
+        privilege = response.json()
+
+        if 'error' in privilege.keys():
+            return privilege, 409 if response.status_code == 409 else 500
+
+        self._db_connector.add_user_tickets(username, tickets)
+
+        return (
+            {
+                'tickets': [
+                    {
+                        'ticketUid': ticket['uid'],
+                        'flightNumber': ticket['flight_number'],
+                        'fromAirport': ticket['from_airport'],
+                        'toAirport': ticket['to_airport'],
+                        'date': ticket['flight_date'],
+                        'price': ticket['price'],
+                        'paidByMoney': ticket['paid_by_money'],
+                        'paidByBonuses': ticket['paid_by_bonuses'],
+                        'status': ticket['status']
+                    }
+                    for ticket in tickets
+                ],
+                'privilege': {
+                    'balance': privilege['balance'],
+                    'status': privilege['status']
+                }
+            },
+            200
+        )
+
+    def _make_purchase_response(self, username, body, purchase):
+        idempotency_key = request.headers.get(TicketService.IDEMPOTENCY_KEY_HEADER)
+
+        if idempotency_key is None:
+            message, code = purchase(str(uuid.uuid4()), {'bonus_requested': False})
+            return make_response(message, code)
+
+        if len(idempotency_key) == 0 or len(idempotency_key) > TicketService.MAX_IDEMPOTENCY_KEY_LENGTH:
+            raise errors.UserError({TicketService.IDEMPOTENCY_KEY_HEADER: 'Invalid header value'}, 400)
+
+        request_hash = hashlib.sha256(f'{request.path} {json.dumps(body, sort_keys=True)}'.encode()).hexdigest()
+
+        is_leader = False
+
+        def purchase_idempotent():
+            nonlocal is_leader
+            is_leader = True
+
+            return self._purchase_ticket_idempotent(username, idempotency_key, request_hash, purchase)
+
+        message, code, replayed = self._purchase_single_flight.do(
+            (username, idempotency_key, request_hash), purchase_idempotent
+        )
+
+        response = make_response(message, code)
+        if replayed or not is_leader:
+            response.headers['Idempotent-Replayed'] = 'true'
+
+        return response
+
+    def _purchase_ticket_idempotent(self, username, idempotency_key, request_hash, purchase):
+        ticket_uid, stored = self._db_connector.claim_idempotency_key(
+            username,
+            idempotency_key,
+            request_hash,
+            str(uuid.uuid4()),
+            self._request_deadline_s * 2,
+            self._idempotency_ttl_s
+        )
+
+        if stored is not None:
+            if stored['request_hash'] != request_hash:
+                raise errors.UserError({'message': 'Idempotency-Key was used with a different request'}, 422)
+
+            if stored['response_code'] is None:
+                raise errors.UserError({'message': 'Request with this Idempotency-Key is in progress'}, 409)
+
+            self._logger.info(f'Replay stored response for idempotency key \'{idempotency_key}\' of user \'{username}\'')
+
+            return json.loads(stored['response_body']), stored['response_code'], True
+
+        progress = {'bonus_requested': False}
+
+        try:
+            message, code = purchase(ticket_uid, progress)
+
+        except BaseException:
+            self._abandon_idempotency_key(username, idempotency_key, progress)
+            raise
+
+        if code >= 500:
+            self._abandon_idempotency_key(username, idempotency_key, progress)
+        else:
+            self._db_connector.complete_idempotency_key(username, idempotency_key, code, json.dumps(message))
+
+        return message, code, False
+
+    def _abandon_idempotency_key(self, username, idempotency_key, progress):
+        if progress['bonus_requested']:
+            self._logger.warning(
+                f'Purchase with idempotency key \'{idempotency_key}\' of user \'{username}\' failed after bonus request, '
+                f'key is left in progress until it goes stale'
+            )
+            return
+
+        self._db_connector.release_idempotency_key(username, idempotency_key)
+
+    def _start_idempotency_keys_purger(self):
+        if self._idempotency_keys_purger_thread is not None:
+            return
+
+        self._idempotency_keys_purger_thread = threading.Thread(
+            target=self._purge_idempotency_keys, name='IdempotencyKeysPurger', daemon=True
+        )
+        self._idempotency_keys_purger_thread.start()
+
+    def _purge_idempotency_keys(self):
+        while True:
+            sleep(self._idempotency_purge_interval_s)
+
+            try:
+                purged = self._db_connector.purge_idempotency_keys(self._idempotency_ttl_s)
+                self._logger.info(f'Purged {purged} expired idempotency keys')
+
+            except Exception as exception:
+                self._logger.error(f'Failed to purge idempotency keys, error: {exception}')
+
+            except errors.ServerError as error:
+                self._logger.error(f'Failed to purge idempotency keys, error: {error.message}')
+
+    def _get_deadline(self):
+        return monotonic() + self._request_deadline_s
+
+    def _get_timeout(self, deadline):
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise errors.ServerError({'error': 'downstream deadline exceeded'}, 504)
+
+        return (min(self._http_client.connect_timeout_s, remaining), min(self._http_client.read_timeout_s, remaining))
+
+    def _wait_all(self, futures, deadline):
+        _, not_done = wait(futures, timeout=max(deadline - monotonic(), 0))
+
+        if len(not_done) != 0:
+            for future in not_done:
+                future.cancel()
+
+            self._logger.warning(f'Downstream deadline exceeded, {len(not_done)} of {len(futures)} requests unfinished')
+            raise errors.ServerError({'error': 'downstream deadline exceeded'}, 504)
+
+        try:
+            return [future.result() for future in futures]
+
+        except requests.exceptions.Timeout as error:
+            self._logger.warning(f'Downstream request timed out: {error}')
+            raise errors.ServerError({'error': 'downstream deadline exceeded'}, 504)
+
+    def _get_privilege(self, auth_headers, deadline):
+        privilege = self._http_client.request(
+            'GET',
+            f'{self._bonus_service_url}/api/v1/privilege',
+            headers=auth_headers,
+            timeout=self._get_timeout(deadline)
+        ).json()
+        if 'error' in privilege.keys():
+            raise errors.ServerError(privilege, 500)
+
+        return privilege
+
+    def _get_flight(self, number, auth_headers, deadline):
+        flight = self._http_client.request(
+            'GET',
+            f'{self._flight_service_url}/api/v1/flights/{number}',
+            headers=auth_headers,
+            timeout=self._get_timeout(deadline)
+        ).json()
+        if 'error' in flight.keys():
+            raise errors.ServerError(flight, 500)
+
+        return flight
+
+    def _get_flights_batch(self, numbers, auth_headers, deadline):
+        response = self._http_client.request(
+            'GET',
+            f'{self._flight_service_url}/api/v1/flights/batch',
+            params={'numbers': ','.join(numbers)},
+            headers=auth_headers,
+            timeout=self._get_timeout(deadline)
+        ).json()
+        if 'error' in response.keys():
+            raise errors.ServerError(response, 500)
+
+        return response['items']
+
+    def _get_flights(self, numbers, auth_headers, deadline):
+        numbers = list(dict.fromkeys(numbers))
+
+        flights = {}
+        uncached = []
+        for number in numbers:
+            flight = self._flight_cache.get(number, TicketService._NOT_CACHED)
+
+            if flight is TicketService._NOT_CACHED:
+                uncached.append(number)
+            elif flight is not None:
+                flights[number] = flight
+
+        futures = [
+            self._fanout_executor.submit(
+                self._get_flights_batch, uncached[begin:begin + TicketService.FLIGHTS_BATCH_SIZE], auth_headers, deadline
+            )
+            for begin in range(0, len(uncached), TicketService.FLIGHTS_BATCH_SIZE)
+        ]
+
+        for batch in self._wait_all(futures, deadline):
+            for flight in batch:
+                flights[flight['flightNumber']] = flight
+                self._flight_cache.put(flight['flightNumber'], flight)
+
+        for number in uncached:
+            if number not in flights:
+                self._flight_cache.put(number, None, expire_time=time() + self._flight_cache_negative_ttl_s)
+
+        missed = [number for number in numbers if number not in flights]
+        if len(missed) != 0:
+            raise errors.ServerError({'error': 'non existent flights', 'flightNumbers': missed}, 500)
+
+        return flights
+
+    def _get_metrics(self):
+        metrics = super()._get_metrics()
+        metrics['flight_cache'] = self._flight_cache.stats()
+        metrics['purchase_requests'] = self._purchase_single_flight.stats()
+
+        return metrics
+
     def _register_routes(self):
         self._register_route('_api_v1_tickets')
         self._register_route('_api_v1_tickets_aUid')
+        self._register_route('_api_v1_tickets_batch')
+        self._register_route('_api_v1_tickets_batch_cancel')
         self._register_route('_api_v1_me')
+        self._register_route('_manage_flight_cache')
 
 
 if __name__ == '__main__':
@@ -358,6 +1037,25 @@ if __name__ == '__main__':
     parser.add_argument('--db-user', type=str, required=True)
     parser.add_argument('--db-password', type=str, required=True)
     parser.add_argument('--db-sslmode', type=str, default='disable')
+    parser.add_argument('--db-pool-min-size', type=int, default=1)
+    parser.add_argument('--db-pool-max-size', type=int, default=10)
+    parser.add_argument('--db-pool-checkout-timeout', type=float, default=5)
+    parser.add_argument('--http-pool-size', type=int, default=10)
+    parser.add_argument('--http-connect-timeout', type=float, default=3)
+    parser.add_argument('--http-read-timeout', type=float, default=10)
+    parser.add_argument('--http-pool-timeout', type=float, default=5)
+    parser.add_argument('--token-cache-size', type=int, default=1024)
+    parser.add_argument('--identity-secret', type=str, default=None)
+    parser.add_argument('--identity-ttl', type=int, default=60)
+    parser.add_argument('--trust-internal-identity', action='store_true')
+    parser.add_argument('--admin-token', type=str, default=None)
+    parser.add_argument('--fanout-workers', type=int, default=16)
+    parser.add_argument('--request-deadline', type=float, default=10)
+    parser.add_argument('--flight-cache-size', type=int, default=4096)
+    parser.add_argument('--flight-cache-ttl', type=float, default=300)
+    parser.add_argument('--flight-cache-negative-ttl', type=float, default=30)
+    parser.add_argument('--idempotency-ttl', type=float, default=86400)
+    parser.add_argument('--idempotency-purge-interval', type=float, default=3600)
     parser.add_argument('--debug', action='store_true')
 
     cmd_args = parser.parse_args()
@@ -376,7 +1074,10 @@ if __name__ == '__main__':
             cmd_args.db,
             cmd_args.db_user,
             cmd_args.db_password,
-            cmd_args.db_sslmode
+            cmd_args.db_sslmode,
+            pool_min_size=cmd_args.db_pool_min_size,
+            pool_max_size=cmd_args.db_pool_max_size,
+            pool_checkout_timeout_s=cmd_args.db_pool_checkout_timeout
         ),
         cmd_args.flight_service_host,
         cmd_args.flight_service_port,
@@ -384,7 +1085,23 @@ if __name__ == '__main__':
         cmd_args.bonus_service_port,
         'cRvxa4PfI6aJTiuOgJoY44qjsj9JFjxx',
         '4yejzOesJYPF-K9P-TIh93w5V4ki0quOIIRuc2MI9WgdUDNCGPj_r6YciYKwjVgg',
-        'dev-r6rulu3m7tph7f63.us.auth0.com'
+        'dev-r6rulu3m7tph7f63.us.auth0.com',
+        http_pool_size=cmd_args.http_pool_size,
+        http_connect_timeout_s=cmd_args.http_connect_timeout,
+        http_read_timeout_s=cmd_args.http_read_timeout,
+        http_pool_timeout_s=cmd_args.http_pool_timeout,
+        token_cache_size=cmd_args.token_cache_size,
+        identity_secret=cmd_args.identity_secret,
+        identity_ttl_s=cmd_args.identity_ttl,
+        trust_internal_identity=cmd_args.trust_internal_identity,
+        admin_token=cmd_args.admin_token,
+        fanout_workers=cmd_args.fanout_workers,
+        request_deadline_s=cmd_args.request_deadline,
+        flight_cache_size=cmd_args.flight_cache_size,
+        flight_cache_ttl_s=cmd_args.flight_cache_ttl,
+        flight_cache_negative_ttl_s=cmd_args.flight_cache_negative_ttl,
+        idempotency_ttl_s=cmd_args.idempotency_ttl,
+        idempotency_purge_interval_s=cmd_args.idempotency_purge_interval
     )
 
     service.run(cmd_args.debug)
@@ -1,10 +1,27 @@
 import logging
 
 
+HOP_BY_HOP_HEADERS = [
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailer',
+    'trailers',
+    'transfer-encoding',
+    'upgrade'
+]
+
+
 def simplify_sql_query(query):
     return " ".join(query.split())
 
 
+def split_list(value, separator=','):
+    return list(dict.fromkeys(item.strip() for item in value.split(separator) if item.strip()))
+
+
 def set_basic_logging_config(level=logging.DEBUG):
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=level)
 
@@ -13,4 +30,18 @@ def is_json_content(content):
     if type(content) is dict:
         return content['Content-Type'] == 'application/json'
 
-    return content.headers['Content-Type'] == 'application/json'
\ No newline at end of file
+    return content.headers['Content-Type'] == 'application/json'
+
+
+def strip_hop_by_hop_headers(headers, extra_headers=()):
+    skipped_headers = set(HOP_BY_HOP_HEADERS)
+    skipped_headers.update(name.lower() for name in extra_headers)
+
+    for connection_header in headers.get('Connection', '').split(','):
+        skipped_headers.add(connection_header.strip().lower())
+
+    return {
+        name: value
+        for name, value in headers.items()
+        if name.lower() not in skipped_headers
+    }